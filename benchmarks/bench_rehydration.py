@@ -0,0 +1,111 @@
+"""
+Micro-benchmark of the extraction of the rehydration JSON from Tiktok video pages
+
+Compares TiktokVideoDetails' fast string search + partial JSON decoding with the
+BeautifulSoup fallback, on saved pages or, without any, on synthetic pages of realistic size:
+
+    python benchmarks/bench_rehydration.py --pages saved_pages/*.html
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from benchmarks.fake_tiktok import PayloadGenerator  # noqa: E402
+from reclaim_tiktok.transcriber.tiktok_video_details import (  # noqa: E402
+    REHYDRATION_SCRIPT_ID,
+    _parse_rehydration_json_fast,
+    _parse_rehydration_json_soup,
+)
+
+
+def synthetic_pages(n, seed=0):
+    """
+    Build Tiktok-like video pages: ~200 KB of markup and other scripts around a rehydration
+    script whose video detail is only a part of the JSON
+    Args:
+        n: number of pages
+        seed: seed of the payload generator
+    Returns:
+        list of html strings
+    """
+    filler = "".join(
+        f'<div class="css-{i}-DivContainer e1{i}"><a href="/tag/{i}">#{i}</a></div>'
+        for i in range(2000)
+    )
+    pages = []
+    for payload in PayloadGenerator(seed=seed).payloads(n):
+        payload["video"]["subtitleInfos"] = [
+            {
+                "LanguageCodeName": language,
+                "Format": "webvtt",
+                "Url": f"https://v16-webapp.tiktok.com/{payload['id']}/{language}.vtt",
+            }
+            for language in ("eng-US", "deu-DE")
+        ]
+        scope = {
+            "webapp.app-context": {"language": "en", "region": "DE", "abTestVersion": filler},
+            "webapp.biz-context": {"renderConfig": [{"key": i} for i in range(500)]},
+            "webapp.video-detail": {
+                "itemInfo": {"itemStruct": payload},
+                "shareMeta": {"title": payload["desc"], "desc": payload["desc"]},
+                "statusCode": 0,
+                "statusMsg": "",
+            },
+            "seo.abtest": {"canonical": f"https://www.tiktok.com/video/{payload['id']}"},
+        }
+        pages.append(
+            f"<!DOCTYPE html><html><head><style>{filler}</style></head><body>{filler}"
+            f'<script id="{REHYDRATION_SCRIPT_ID}" type="application/json">'
+            f'{json.dumps({"__DEFAULT_SCOPE__": scope})}</script>'
+            f"<script>window.SIGI_STATE={{}}</script></body></html>"
+        )
+    return pages
+
+
+def bench(parse, pages, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for page in pages:
+            parse(page)
+    return (time.perf_counter() - start) / (repeat * len(pages))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--pages", nargs="*", default=[], help="saved Tiktok video pages")
+    parser.add_argument("--synthetic", type=int, default=20, help="pages to build without any")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    pages = []
+    for path in args.pages:
+        with open(path, encoding="utf-8") as f:
+            pages.append(f.read())
+    if not pages:
+        pages = synthetic_pages(args.synthetic)
+
+    for page in pages:
+        fast = _parse_rehydration_json_fast(page)
+        soup = _parse_rehydration_json_soup(page)
+        detail = "webapp.video-detail"
+        if fast is None or soup is None:
+            assert fast == soup, "fast path and BeautifulSoup disagree on a missing script"
+        elif detail in soup["__DEFAULT_SCOPE__"]:
+            assert fast["__DEFAULT_SCOPE__"][detail] == soup["__DEFAULT_SCOPE__"][detail]
+
+    size = sum(len(page) for page in pages) / len(pages)
+    soup_seconds = bench(_parse_rehydration_json_soup, pages, args.repeat)
+    fast_seconds = bench(_parse_rehydration_json_fast, pages, args.repeat)
+    print(f"{len(pages)} pages of {size / 1024:.0f} KB on average")
+    print(f"BeautifulSoup + json.loads: {soup_seconds * 1000:8.2f} ms/page")
+    print(f"find + raw_decode:          {fast_seconds * 1000:8.2f} ms/page")
+    print(f"speedup:                    {soup_seconds / fast_seconds:8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,190 @@
+"""
+Offline throughput benchmark of the Scrapper: crawl, processing, filtering and ingest
+
+TikTok is replaced by FakeTikTokApi (deterministic payloads modelled on
+data/afd_01-01-2024_30-04-2024.json) and the Azure SQL database by a SQLite stand-in, so the
+numbers can be compared between commits and ingest strategies on a laptop:
+
+    python benchmarks/bench_scrapper.py --sizes 1000 100000 1000000 --json results.json
+
+Every size is run in chunks of --chunk-size videos (one crawl batch each), so memory stays
+bounded at 1M videos. Rates are videos per second through each stage.
+"""
+
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import sys
+import time
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from benchmarks.fake_tiktok import FakeTikTokApi, FakeVideo, PayloadGenerator  # noqa: E402
+from benchmarks.sqlite_odbc import SqliteOdbc  # noqa: E402
+from reclaim_tiktok.scrapping import scrapper as scrapper_module  # noqa: E402
+from reclaim_tiktok.scrapping.rate_limiter import AdaptiveRateLimiter  # noqa: E402
+from reclaim_tiktok.scrapping.scrapper import Scrapper  # noqa: E402
+from reclaim_tiktok.scrapping.session_pool import SessionPool  # noqa: E402
+
+DEFAULT_SIZES = (1000, 100_000, 1_000_000)
+DEFAULT_CHUNK_SIZE = 100_000
+# Ways of writing a batch of processed videos to the database
+INGEST_STRATEGIES = ("ingest_batch", "add_to_db")
+
+
+class Timings:
+    """Accumulated seconds and videos per benchmark stage"""
+
+    def __init__(self):
+        self.seconds = {}
+        self.videos = {}
+
+    @contextlib.contextmanager
+    def measure(self, stage, videos):
+        start = time.perf_counter()
+        # the scrapper reports every batch, keep the benchmark output readable
+        with contextlib.redirect_stdout(io.StringIO()):
+            yield
+        self.seconds[stage] = self.seconds.get(stage, 0.0) + time.perf_counter() - start
+        self.videos[stage] = self.videos.get(stage, 0) + videos
+
+    def results(self, size):
+        return [
+            {
+                "size": size,
+                "stage": stage,
+                "videos": self.videos[stage],
+                "seconds": seconds,
+                "videos_per_second": self.videos[stage] / seconds if seconds else float("inf"),
+            }
+            for stage, seconds in self.seconds.items()
+        ]
+
+
+def make_scrapper(generator):
+    """
+    Create a scrapper crawling the fake TikTok API without rate limiting
+    Args:
+        generator: PayloadGenerator of the fake API
+    Returns:
+        Scrapper
+    """
+    unlimited = 10**9
+    return Scrapper(
+        ms_token="benchmark",
+        session_pool=SessionPool(sleep_after=0, api_factory=lambda: FakeTikTokApi(generator)),
+        rate_limiter=AdaptiveRateLimiter(
+            initial_rate=unlimited, max_rate=unlimited, burst=unlimited
+        ),
+    )
+
+
+def ingest(scrapper, strategy, processed_videos, batch_size):
+    """
+    Write processed videos to the (stand-in) database
+    Args:
+        scrapper: Scrapper
+        strategy: "ingest_batch" (one transaction) or "add_to_db" (one commit per table)
+        processed_videos: list of processed videos
+        batch_size: number of rows sent to the database per round trip
+    """
+    if strategy == "ingest_batch":
+        scrapper.ingest_batch(processed_videos, "stand-in", batch_size)
+    else:
+        scrapper.add_users_to_db_from_list_of_videos(processed_videos, "stand-in", batch_size)
+        scrapper.add_sounds_to_db(processed_videos, "stand-in", batch_size)
+        scrapper.add_videos_to_db(processed_videos, "stand-in", batch_size)
+
+
+def bench_size(size, chunk_size, batch_size, strategies, num_sessions, seed):
+    """
+    Run all stages for one number of videos
+    Args:
+        size: number of videos
+        chunk_size: number of videos handled at once
+        batch_size: number of rows sent to the database per round trip
+        strategies: ingest strategies to compare
+        num_sessions: number of fake TikTok sessions of the crawl
+        seed: seed of the payload generator
+    Returns:
+        list of result dictionaries, one per stage
+    """
+    generator = PayloadGenerator(seed=seed)
+    scrapper = make_scrapper(generator)
+    databases = {strategy: SqliteOdbc() for strategy in strategies}
+    timings = Timings()
+
+    for offset in range(0, size, chunk_size):
+        n = min(chunk_size, size - offset)
+
+        hashtags = [f"hashtag{offset + i}" for i in range(num_sessions)]
+        per_hashtag = -(-n // num_sessions)
+        with timings.measure("crawl (fake api)", per_hashtag * num_sessions):
+            asyncio.run(
+                scrapper.search_videos_by_hashtags_concurrent(
+                    count=per_hashtag, hashtags=hashtags, num_sessions=num_sessions
+                )
+            )
+
+        videos = [FakeVideo(payload) for payload in generator.payloads(n, offset)]
+        with timings.measure("filter_unique_videos", n):
+            unique_videos = scrapper.filter_unique_videos(videos)
+        with timings.measure("process_video", len(unique_videos)):
+            processed_videos = [scrapper.process_video(video) for video in unique_videos]
+        with timings.measure("filter_unique_sounds", len(processed_videos)):
+            scrapper.filter_unique_sounds(processed_videos)
+
+        for strategy, database in databases.items():
+            with mock.patch.object(scrapper_module, "pyodbc", database):
+                with timings.measure(f"{strategy} (new)", len(processed_videos)):
+                    ingest(scrapper, strategy, processed_videos, batch_size)
+                with timings.measure(f"{strategy} (existing)", len(processed_videos)):
+                    ingest(scrapper, strategy, processed_videos, batch_size)
+
+    asyncio.run(scrapper.close())
+    for strategy, database in databases.items():
+        stored = database.count("dbo.Videos")
+        print(f"{strategy}: {stored} videos stored for {size} generated")
+    return timings.results(size)
+
+
+def print_results(results):
+    print(f"{'size':>9}  {'stage':<28}{'videos':>10}{'seconds':>10}{'videos/s':>12}")
+    for result in results:
+        print(
+            f"{result['size']:>9}  {result['stage']:<28}{result['videos']:>10}"
+            f"{result['seconds']:>10.2f}{result['videos_per_second']:>12.0f}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES)
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE)
+    parser.add_argument("--batch-size", type=int, default=scrapper_module.DEFAULT_BATCH_SIZE)
+    parser.add_argument(
+        "--strategies", nargs="+", choices=INGEST_STRATEGIES, default=INGEST_STRATEGIES
+    )
+    parser.add_argument("--num-sessions", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="write the results to this file for later comparison")
+    args = parser.parse_args()
+
+    results = []
+    for size in args.sizes:
+        results += bench_size(
+            size, args.chunk_size, args.batch_size, args.strategies, args.num_sessions, args.seed
+        )
+    print_results(results)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""
+Micro-benchmark of the conversion of WebVTT subtitles to transcripts
+
+Compares TiktokVideoDetails' single-pass extractor with the previous webvtt-py caption loop,
+on saved subtitles or, without any, on synthetic tracks of Tiktok-like cues:
+
+    python benchmarks/bench_vtt.py --files subtitles/*.vtt
+"""
+
+import argparse
+import io
+import os
+import random
+import sys
+import time
+import warnings
+
+import webvtt
+from webvtt.errors import MalformedCaptionError, MalformedFileError
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from reclaim_tiktok.transcriber.tiktok_video_details import vtt_to_transcript  # noqa: E402
+
+WORDS = "und die der ich das ist nicht the and you that it to of ja so mal heute".split()
+
+
+def synthetic_tracks(n, cues, seed=0):
+    """
+    Build WebVTT tracks like Tiktok's auto-captions, with identifiers, cue settings, notes and
+    some cue tags
+    Args:
+        n: number of tracks
+        cues: number of cues per track
+        seed: seed of the random generator
+    Returns:
+        list of WebVTT strings
+    """
+    rng = random.Random(seed)
+    tracks = []
+    for _ in range(n):
+        lines = ["WEBVTT", "Kind: captions", "", "NOTE generated", ""]
+        for cue in range(cues):
+            start = cue * 1.5
+            if rng.random() < 0.5:
+                lines.append(str(cue + 1))
+            lines.append(
+                f"00:{int(start // 60):02d}:{start % 60:06.3f} --> "
+                f"00:{int((start + 1.5) // 60):02d}:{(start + 1.5) % 60:06.3f} line:90%"
+            )
+            for _ in range(rng.choice((1, 1, 2))):
+                text = " ".join(rng.choice(WORDS) for _ in range(rng.randint(3, 9)))
+                lines.append(f"<c.white>{text}</c>" if rng.random() < 0.2 else text)
+            lines.append("")
+        tracks.append("\r\n".join(lines) if rng.random() < 0.3 else "\n".join(lines))
+    return tracks
+
+
+def webvtt_transcript(vtt):
+    transcript = ""
+    for caption in webvtt.read_buffer(io.StringIO(vtt)):
+        transcript += f"{caption.text} "
+    return transcript
+
+
+def bench(convert, tracks, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for track in tracks:
+            convert(track)
+    return (time.perf_counter() - start) / (repeat * len(tracks))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--files", nargs="*", default=[], help="saved WebVTT subtitles")
+    parser.add_argument("--synthetic", type=int, default=50, help="tracks to build without any")
+    parser.add_argument("--cues", type=int, default=400, help="cues per synthetic track")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    warnings.simplefilter("ignore", DeprecationWarning)
+
+    tracks = []
+    for path in args.files:
+        with open(path, encoding="utf-8") as f:
+            tracks.append(f.read())
+    if not tracks:
+        tracks = synthetic_tracks(args.synthetic, args.cues)
+
+    for track in tracks:
+        try:
+            expected = webvtt_transcript(track)
+        except (MalformedFileError, MalformedCaptionError):
+            continue
+        assert vtt_to_transcript(track) == expected, "extractor and webvtt-py disagree"
+
+    size = sum(len(track) for track in tracks) / len(tracks)
+    webvtt_seconds = bench(webvtt_transcript, tracks, args.repeat)
+    fast_seconds = bench(vtt_to_transcript, tracks, args.repeat)
+    print(f"{len(tracks)} tracks of {size / 1024:.0f} KB on average")
+    print(f"webvtt-py + str +=: {webvtt_seconds * 1000:8.2f} ms/track")
+    print(f"vtt_to_transcript:  {fast_seconds * 1000:8.2f} ms/track")
+    print(f"speedup:            {webvtt_seconds / fast_seconds:8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,223 @@
+import asyncio
+import json
+import os
+import random
+import re
+
+SAMPLE_PATH = os.path.join(
+    os.path.dirname(__file__), "..", "data", "afd_01-01-2024_30-04-2024.json"
+)
+# Used when the sample data is not available
+FALLBACK_SAMPLES = [
+    {
+        "creator_username": "alvaro__live",
+        "creator_follower_count": 108127,
+        "desc": "AFD Statement #fyp #afd ",
+        "duration": 60,
+        "likes": 354,
+        "views": 24687,
+        "create_time": 1705579666,
+        "is_ad": False,
+    },
+    {
+        "creator_username": "annamarinada",
+        "creator_follower_count": 77661,
+        "desc": "Ganzes Interview auf X (@AfD). #fyp",
+        "duration": 43,
+        "likes": 9125,
+        "views": 71196,
+        "create_time": 1712575946,
+        "is_ad": False,
+    },
+]
+FIRST_VIDEO_ID = 7300000000000000000
+FIRST_AUTHOR_ID = 6800000000000000000
+FIRST_SOUND_ID = 7100000000000000000
+
+
+def load_samples(path=SAMPLE_PATH):
+    """
+    Load the scraped example videos the fake payloads are modelled on
+    Args:
+        path: path to a seeksocial export like data/afd_01-01-2024_30-04-2024.json
+    Returns:
+        list of video dictionaries of the export
+    """
+    if not os.path.exists(path):
+        return FALLBACK_SAMPLES
+    with open(path, encoding="utf-8") as f:
+        return [hit["_source"] for hit in json.load(f)["hits"]["hits"]]
+
+
+class PayloadGenerator:
+    """
+    Deterministic generator of TikTokApi video.as_dict payloads
+
+    Descriptions, usernames, durations, counts and timestamps are drawn from real scraped
+    videos, while ids are synthetic: authors and sounds are shared between videos (like on
+    TikTok) and a share of the videos repeats an earlier id, as happens across hashtags.
+    """
+
+    def __init__(self, seed=0, videos_per_author=5, videos_per_sound=3, duplicate_rate=0.1):
+        """
+        Initialize the generator
+        Args:
+            seed: seed of the random generator, the same seed gives the same payloads
+            videos_per_author: average number of videos per author
+            videos_per_sound: average number of videos per sound
+            duplicate_rate: share of payloads that repeat the id of an earlier payload
+        """
+        self.seed = seed
+        self.videos_per_author = videos_per_author
+        self.videos_per_sound = videos_per_sound
+        self.duplicate_rate = duplicate_rate
+        self.samples = load_samples()
+
+    def payloads(self, n, offset=0):
+        """
+        Generate video payloads
+        Args:
+            n: number of payloads
+            offset: index of the first payload, to continue a previous call
+        Returns:
+            list of video dictionaries
+        """
+        rng = random.Random(f"{self.seed}-{offset}")
+        payloads = []
+        for i in range(offset, offset + n):
+            video_number = i
+            if i > offset and rng.random() < self.duplicate_rate:
+                video_number = rng.randrange(max(offset, i - 1000), i)
+            payloads.append(self._payload(video_number))
+        return payloads
+
+    def _payload(self, video_number):
+        # the same video number always gives the same payload
+        rng = random.Random(self.seed * 1_000_003 + video_number)
+        sample = self.samples[video_number % len(self.samples)]
+        author_number = rng.randrange(video_number // self.videos_per_author + 1)
+        sound_number = rng.randrange(video_number // self.videos_per_sound + 1)
+        original_sound = sound_number % 2 == 0
+        username = f"{sample.get('creator_username', 'user')}{author_number}"
+        desc = sample.get("desc") or ""
+        likes = int(sample.get("likes") or 0)
+
+        payload = {
+            "id": str(FIRST_VIDEO_ID + video_number),
+            "createTime": int(sample.get("create_time") or 1704067200) + video_number % 86400,
+            "desc": desc,
+            "video": {"duration": int(sample.get("duration") or 0), "ratio": "720p"},
+            "statsV2": {
+                "diggCount": str(likes),
+                "shareCount": str(likes // 20),
+                "commentCount": str(likes // 10),
+                "playCount": str(int(sample.get("views") or 0)),
+                "collectCount": str(likes // 30),
+            },
+            "author": {
+                "id": str(FIRST_AUTHOR_ID + author_number),
+                "uniqueId": username,
+                "nickname": username.replace("_", " ").title(),
+                "verified": author_number % 50 == 0,
+                "secUid": f"MS4wLjABAAAA{author_number:032d}",
+            },
+            "authorStats": {
+                "followerCount": int(sample.get("creator_follower_count") or 0),
+                "followingCount": author_number % 700,
+                "heart": likes * 40,
+                "videoCount": 20 + author_number % 300,
+                "diggCount": author_number % 5000,
+            },
+            "music": {
+                "id": str(FIRST_SOUND_ID + sound_number),
+                "title": f"original sound - {username}" if original_sound else desc[:30],
+                "original": original_sound,
+                "authorName": username,
+            },
+            "textExtra": [{"hashtagName": tag, "type": 1} for tag in re.findall(r"#(\w+)", desc)],
+        }
+        if not original_sound:
+            payload["music"]["album"] = f"Album {sound_number % 1000}"
+        if sample.get("is_ad"):
+            payload["isAd"] = True
+        return payload
+
+
+class FakeVideo:
+    """Stand-in for a TikTokApi video object"""
+
+    def __init__(self, payload):
+        self.id = payload["id"]
+        self.as_dict = payload
+
+
+class _FakeFeed:
+    def __init__(self, api, name, generator_offset):
+        self.api = api
+        self.name = name
+        self.generator_offset = generator_offset
+
+    async def info(self, **kwargs):
+        return {"userInfo": {"user": {"uniqueId": self.name}}}
+
+    async def videos(self, count=30, cursor=0, **kwargs):
+        # cursor is an offset for hashtags and a createTime in ms for users, the fake feed
+        # only pages by offset
+        cursor = cursor if cursor < 10**9 else 0
+        payloads = self.api.generator.payloads(count, self.generator_offset + cursor)
+        for i, payload in enumerate(payloads):
+            if self.api.page_latency and i % 35 == 0:
+                await asyncio.sleep(self.api.page_latency)
+            yield FakeVideo(payload)
+
+
+class _FakePage:
+    def is_closed(self):
+        return False
+
+    async def evaluate(self, expression):
+        return 1
+
+
+class _FakeSession:
+    def __init__(self):
+        self.page = _FakePage()
+
+
+class FakeTikTokApi:
+    """
+    Offline stand-in for TikTokApi: hashtags and users return generated payloads
+    Pass it to SessionPool(api_factory=...) to run the crawl methods of the Scrapper.
+    """
+
+    def __init__(self, generator=None, page_latency=0.0):
+        """
+        Initialize the fake API
+        Args:
+            generator: PayloadGenerator, a default one if None
+            page_latency: seconds every page of 35 videos takes, to mimic the network
+        """
+        self.generator = generator or PayloadGenerator()
+        self.page_latency = page_latency
+        self.sessions = []
+        self._feeds = 0
+
+    async def create_sessions(self, ms_tokens=None, num_sessions=1, **kwargs):
+        self.sessions = [_FakeSession() for _ in range(num_sessions)]
+
+    async def close_sessions(self):
+        self.sessions = []
+
+    async def stop_playwright(self):
+        pass
+
+    def hashtag(self, name):
+        return self._feed(name)
+
+    def user(self, username):
+        return self._feed(username)
+
+    def _feed(self, name):
+        # every feed gets its own range of videos, overlapping through duplicate_rate
+        self._feeds += 1
+        return _FakeFeed(self, name, self._feeds * 10**7)
@@ -0,0 +1,175 @@
+import datetime
+import os
+import re
+import sqlite3
+import tempfile
+
+# SQLite versions of dbo.Users, dbo.Sounds and dbo.Videos with the columns the scrapper writes
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS dbo.Users (
+    id INTEGER PRIMARY KEY,
+    unique_name_id TEXT,
+    nickname TEXT,
+    follower_count INTEGER,
+    following_count INTEGER,
+    heart_count INTEGER,
+    video_count INTEGER,
+    digg_count INTEGER,
+    verified INTEGER
+);
+CREATE TABLE IF NOT EXISTS dbo.Sounds (
+    id INTEGER PRIMARY KEY,
+    title TEXT,
+    original_sound INTEGER,
+    album TEXT,
+    author_name TEXT,
+    url TEXT
+);
+CREATE TABLE IF NOT EXISTS dbo.Videos (
+    id INTEGER PRIMARY KEY,
+    timestamp_upload TEXT,
+    timestamp_db TEXT,
+    duration REAL,
+    digg_count INTEGER,
+    share_count INTEGER,
+    comment_count INTEGER,
+    play_count INTEGER,
+    description TEXT,
+    is_ad INTEGER,
+    author_id INTEGER,
+    suggested_words TEXT,
+    url TEXT,
+    transcript_en TEXT,
+    transcript_de TEXT,
+    sound_id INTEGER,
+    removed INTEGER,
+    has_transcript INTEGER,
+    no_transcript_reason TEXT,
+    core_messages_de TEXT
+);
+"""
+
+_SELECT_INTO = re.compile(r"SELECT TOP 0 (.+) INTO #(\w+) FROM (\S+)", re.S)
+_MERGE = re.compile(
+    r"MERGE (?P<table>\S+) WITH.*?FROM #(?P<staging>\w+).*?INSERT \((?P<columns>[^)]*)\)", re.S
+)
+
+sqlite3.register_adapter(datetime.datetime, lambda value: value.isoformat(" "))
+
+
+def _translate(query):
+    """
+    Translate the T-SQL statements of Scrapper._bulk_insert and _existing_ids to SQLite
+    Args:
+        query: T-SQL statement
+    Returns:
+        SQLite statement
+    """
+    if match := _MERGE.search(query):
+        # the primary key skips existing ids and repeated ids within the staging table
+        table, staging, columns = match.group("table", "staging", "columns")
+        return f"INSERT OR IGNORE INTO {table} ({columns}) SELECT {columns} FROM temp.{staging}"
+    if match := _SELECT_INTO.search(query):
+        columns, staging, table = match.groups()
+        return f"CREATE TEMP TABLE {staging} AS SELECT {columns} FROM {table} LIMIT 0"
+    return re.sub(r"#(\w+)", r"temp.\1", query)
+
+
+class Cursor:
+    """pyodbc-like cursor on a SQLite connection"""
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+        self.fast_executemany = False
+
+    @property
+    def rowcount(self):
+        return self._cursor.rowcount
+
+    def execute(self, query, *params):
+        if len(params) == 1 and isinstance(params[0], (list, tuple)):
+            params = params[0]
+        self._cursor.execute(_translate(query), params)
+        return self
+
+    def executemany(self, query, rows):
+        self._cursor.executemany(_translate(query), rows)
+        return self
+
+    def fetchone(self):
+        return self._cursor.fetchone()
+
+    def fetchmany(self, size=1):
+        return self._cursor.fetchmany(size)
+
+    def fetchall(self):
+        return self._cursor.fetchall()
+
+
+class Connection:
+    """pyodbc-like connection to the SQLite stand-in database"""
+
+    def __init__(self, path, autocommit=False):
+        self._cnxn = sqlite3.connect(path, isolation_level=None if autocommit else "DEFERRED")
+        self._cnxn.execute(f"ATTACH DATABASE '{path}.dbo' AS dbo")
+
+    def cursor(self):
+        return Cursor(self._cnxn.cursor())
+
+    def commit(self):
+        self._cnxn.commit()
+
+    def rollback(self):
+        self._cnxn.rollback()
+
+    def close(self):
+        self._cnxn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # like pyodbc: commit on success, the connection itself stays open
+        if exc_type is None:
+            self.commit()
+        else:
+            self.rollback()
+
+
+class SqliteOdbc:
+    """
+    Local stand-in for pyodbc and the Azure SQL database, backed by a SQLite file
+    Replace the pyodbc module of the scrapper with it to run the ingest offline:
+        mock.patch.object(scrapper, "pyodbc", SqliteOdbc())
+    The connection string is ignored, every connection opens the same database.
+    """
+
+    def __init__(self, path=None):
+        """
+        Initialize the stand-in database
+        Args:
+            path: path to the SQLite file, a new temporary file if None
+        """
+        if path is None:
+            directory = tempfile.mkdtemp(prefix="reclaim_tiktok_bench_")
+            path = os.path.join(directory, "main.sqlite")
+        self.path = path
+        with self.connect("") as cnxn:
+            cnxn._cnxn.executescript(SCHEMA)
+
+    def connect(self, connection_str, autocommit=False):
+        return Connection(self.path, autocommit=autocommit)
+
+    def count(self, table):
+        """
+        Count the rows of a table
+        Args:
+            table: e.g. "dbo.Videos"
+        Returns:
+            number of rows
+        """
+        cnxn = self.connect("")
+        try:
+            return cnxn.cursor().execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+        finally:
+            cnxn.close()
@@ -0,0 +1,94 @@
+import datetime
+import sqlite3
+
+DEFAULT_CHECKPOINT_PATH = "crawl_checkpoints.sqlite"
+
+
+class CheckpointStore:
+    """
+    Persists the crawl progress per hashtag and per user in a local SQLite file
+
+    For every (kind, key) pair, e.g. ("hashtag", "afd") or ("user", "afd.bund"), it records
+    - cursor: the TikTok cursor to continue an unfinished crawl from (None once finished)
+    - newest_create_time: the newest createTime of all videos seen so far
+    """
+
+    def __init__(self, path=DEFAULT_CHECKPOINT_PATH):
+        """
+        Initialize the checkpoint store
+        Args:
+            path: path to the SQLite file (created if it does not exist)
+        """
+        self.path = path
+        self.cnxn = sqlite3.connect(path, check_same_thread=False)
+        self.cnxn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS checkpoints (
+                kind TEXT NOT NULL,
+                key TEXT NOT NULL,
+                cursor INTEGER,
+                newest_create_time INTEGER,
+                updated_at TEXT NOT NULL,
+                PRIMARY KEY (kind, key)
+            )
+            """
+        )
+        self.cnxn.commit()
+
+    def get(self, kind, key):
+        """
+        Get the checkpoint of a hashtag or user
+        Args:
+            kind: "hashtag" or "user"
+            key: the hashtag or username
+        Returns:
+            dict with cursor and newest_create_time, or None if the target was never crawled
+        """
+        row = self.cnxn.execute(
+            "SELECT cursor, newest_create_time FROM checkpoints WHERE kind = ? AND key = ?",
+            (kind, key),
+        ).fetchone()
+        if row is None:
+            return None
+        return {"cursor": row[0], "newest_create_time": row[1]}
+
+    def save(self, kind, key, cursor, newest_create_time):
+        """
+        Save the checkpoint of a hashtag or user
+        The stored newest_create_time only ever moves forward.
+        Args:
+            kind: "hashtag" or "user"
+            key: the hashtag or username
+            cursor: cursor to continue from, None if the crawl finished
+            newest_create_time: newest createTime seen in this crawl (or None)
+        """
+        self.cnxn.execute(
+            """
+            INSERT INTO checkpoints (kind, key, cursor, newest_create_time, updated_at)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (kind, key) DO UPDATE SET
+                cursor = excluded.cursor,
+                newest_create_time = MAX(
+                    COALESCE(checkpoints.newest_create_time, 0),
+                    COALESCE(excluded.newest_create_time, 0)
+                ),
+                updated_at = excluded.updated_at
+            """,
+            (kind, key, cursor, newest_create_time, datetime.datetime.now().isoformat()),
+        )
+        self.cnxn.commit()
+
+    def reset(self, kind=None, key=None):
+        """
+        Delete checkpoints, so the next crawl starts from scratch
+        Args:
+            kind: only delete checkpoints of this kind (all if None)
+            key: only delete the checkpoint of this hashtag or user (all if None)
+        """
+        query = "DELETE FROM checkpoints WHERE (? IS NULL OR kind = ?) AND (? IS NULL OR key = ?)"
+        self.cnxn.execute(query, (kind, kind, key, key))
+        self.cnxn.commit()
+
+    def close(self):
+        """Close the connection to the SQLite file"""
+        self.cnxn.close()
@@ -0,0 +1,161 @@
+import datetime
+import sqlite3
+import threading
+
+import pyodbc
+
+DEFAULT_INDEX_PATH = "known_ids.sqlite"
+KINDS = ("videos", "users", "sounds")
+# SQLite accepts at most 999 parameters per statement in older versions
+MAX_SQLITE_PARAMETERS = 900
+# Number of rows fetched from the SQL database at once while syncing
+SYNC_PAGE_SIZE = 10000
+
+
+class KnownIdIndex:
+    """
+    Local on-disk index of the video, user and sound ids already stored in the SQL database
+
+    The index lives in a SQLite file in WAL mode, so several processes on one node can read and
+    update it at the same time. It is filled by sync_from_db, which only fetches what was
+    added to dbo.Videos since the last sync (by timestamp_db), and by the scrapper after every
+    committed insert.
+    """
+
+    def __init__(self, path=DEFAULT_INDEX_PATH):
+        """
+        Initialize the index
+        Args:
+            path: path to the SQLite file (created if it does not exist)
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self.cnxn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.cnxn.execute("PRAGMA journal_mode=WAL")
+        self.cnxn.execute("PRAGMA synchronous=NORMAL")
+        for kind in KINDS:
+            self.cnxn.execute(f"CREATE TABLE IF NOT EXISTS {kind} (id INTEGER PRIMARY KEY)")
+        self.cnxn.execute(
+            "CREATE TABLE IF NOT EXISTS sync_state (key TEXT PRIMARY KEY, value TEXT NOT NULL)"
+        )
+        self.cnxn.commit()
+
+    def contains(self, kind, ids):
+        """
+        Get the ids that are in the index
+        Args:
+            kind: "videos", "users" or "sounds"
+            ids: ids to look up
+        Returns:
+            set of the ids that are in the index
+        """
+        self._check_kind(kind)
+        ids = [int(id_) for id_ in ids]
+        known_ids = set()
+        with self._lock:
+            for i in range(0, len(ids), MAX_SQLITE_PARAMETERS):
+                chunk = ids[i : i + MAX_SQLITE_PARAMETERS]
+                placeholders = ", ".join("?" * len(chunk))
+                rows = self.cnxn.execute(
+                    f"SELECT id FROM {kind} WHERE id IN ({placeholders})", chunk
+                ).fetchall()
+                known_ids.update(row[0] for row in rows)
+        return known_ids
+
+    def is_known(self, kind, id_):
+        """
+        Check if a single id is in the index
+        Args:
+            kind: "videos", "users" or "sounds"
+            id_: id to look up
+        Returns:
+            True if the id is in the index
+        """
+        self._check_kind(kind)
+        with self._lock:
+            row = self.cnxn.execute(f"SELECT 1 FROM {kind} WHERE id = ?", (int(id_),)).fetchone()
+        return row is not None
+
+    def add(self, kind, ids):
+        """
+        Add ids to the index
+        Args:
+            kind: "videos", "users" or "sounds"
+            ids: ids that are stored in the SQL database
+        """
+        self._check_kind(kind)
+        with self._lock:
+            self.cnxn.executemany(
+                f"INSERT OR IGNORE INTO {kind} (id) VALUES (?)",
+                ((int(id_),) for id_ in ids if id_ is not None),
+            )
+            self.cnxn.commit()
+
+    def sync_from_db(self, connection_str):
+        """
+        Fetch the ids added to the SQL database since the last sync
+        Videos are synced by timestamp_db, users and sounds through the author_id and sound_id
+        of those videos. The first sync additionally copies all of dbo.Users and dbo.Sounds,
+        which also covers users and sounds that were added without a video.
+        Args:
+            connection_str: connection string to the SQL database
+        Returns:
+            number of videos fetched
+        """
+        last_sync = self._get_state("videos_timestamp_db")
+        if last_sync is not None:
+            last_sync = datetime.datetime.fromisoformat(last_sync)
+        fetched = 0
+        newest = last_sync
+
+        with pyodbc.connect(connection_str) as cnxn:
+            cursor = cnxn.cursor()
+
+            if last_sync is None:
+                for kind, table in (("users", "dbo.Users"), ("sounds", "dbo.Sounds")):
+                    cursor.execute(f"SELECT id FROM {table}")
+                    while rows := cursor.fetchmany(SYNC_PAGE_SIZE):
+                        self.add(kind, (row[0] for row in rows))
+
+            query = "SELECT id, author_id, sound_id, timestamp_db FROM dbo.Videos"
+            params = []
+            if last_sync is not None:
+                query += " WHERE timestamp_db > ?"
+                params.append(last_sync)
+            cursor.execute(query, params)
+
+            while rows := cursor.fetchmany(SYNC_PAGE_SIZE):
+                self.add("videos", (row[0] for row in rows))
+                self.add("users", (row[1] for row in rows))
+                self.add("sounds", (row[2] for row in rows))
+                fetched += len(rows)
+                page_newest = max((row[3] for row in rows if row[3] is not None), default=None)
+                if page_newest is not None and (newest is None or page_newest > newest):
+                    newest = page_newest
+
+        if newest is not None:
+            self._set_state("videos_timestamp_db", newest.isoformat())
+        print(f"Synced {fetched} new videos into the known id index")
+        return fetched
+
+    def close(self):
+        """Close the connection to the SQLite file"""
+        self.cnxn.close()
+
+    def _check_kind(self, kind):
+        if kind not in KINDS:
+            raise ValueError(f"kind must be one of {KINDS}")
+
+    def _get_state(self, key):
+        with self._lock:
+            row = self.cnxn.execute(
+                "SELECT value FROM sync_state WHERE key = ?", (key,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def _set_state(self, key, value):
+        with self._lock:
+            self.cnxn.execute(
+                "INSERT OR REPLACE INTO sync_state (key, value) VALUES (?, ?)", (key, value)
+            )
+            self.cnxn.commit()
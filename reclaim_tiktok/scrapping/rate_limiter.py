@@ -0,0 +1,141 @@
+import asyncio
+import random
+import time
+
+
+class _Bucket:
+    """State of the token bucket of one session"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+        self.backoff_until = 0.0
+        self.consecutive_failures = 0
+        self.successes = 0
+        self.failures = {}
+
+
+class AdaptiveRateLimiter:
+    """
+    Token bucket rate limiter per TikTok session (and thereby per ms_token)
+
+    The rate of every bucket adapts to the responses of its session: each successful request
+    adds increase requests/s (up to max_rate), each error, captcha or empty page multiplies
+    the rate by decrease (down to min_rate) and pauses the session with a jittered exponential
+    backoff. This converges to the highest rate TikTok tolerates without losing the session.
+    """
+
+    def __init__(
+        self,
+        initial_rate=1.0,
+        min_rate=0.05,
+        max_rate=5.0,
+        increase=0.05,
+        decrease=0.5,
+        burst=3,
+        base_backoff=2.0,
+        max_backoff=300.0,
+    ):
+        """
+        Initialize the rate limiter
+        Args:
+            initial_rate: requests per second a new session starts with
+            min_rate: lowest requests per second a session is slowed down to
+            max_rate: highest requests per second a session is sped up to
+            increase: requests per second added after every successful request
+            decrease: factor the rate is multiplied with after every failed request
+            burst: number of requests a session may make at once after being idle
+            base_backoff: seconds of backoff after the first failure, doubled for every
+                further failure in a row
+            max_backoff: upper bound of the backoff in seconds
+        """
+        self.initial_rate = initial_rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.burst = burst
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self._buckets = {}
+
+    def _bucket(self, key):
+        if key not in self._buckets:
+            self._buckets[key] = _Bucket(self.initial_rate, self.burst)
+        return self._buckets[key]
+
+    async def acquire(self, key=0):
+        """
+        Wait until the session may make its next request
+        Args:
+            key: session index (or ms_token) identifying the bucket
+        """
+        bucket = self._bucket(key)
+        while True:
+            now = time.monotonic()
+            if now < bucket.backoff_until:
+                await asyncio.sleep(bucket.backoff_until - now)
+                continue
+
+            bucket.tokens = min(
+                self.burst, bucket.tokens + (now - bucket.updated_at) * bucket.rate
+            )
+            bucket.updated_at = now
+            if bucket.tokens >= 1:
+                bucket.tokens -= 1
+                return
+            await asyncio.sleep((1 - bucket.tokens) / bucket.rate)
+
+    def report_success(self, key=0):
+        """
+        Report a successful request: speed the session up additively
+        Args:
+            key: session index (or ms_token) identifying the bucket
+        """
+        bucket = self._bucket(key)
+        bucket.successes += 1
+        bucket.consecutive_failures = 0
+        bucket.rate = min(self.max_rate, bucket.rate + self.increase)
+
+    def report_failure(self, key=0, reason="error"):
+        """
+        Report a failed request: slow the session down multiplicatively and back off
+        Args:
+            key: session index (or ms_token) identifying the bucket
+            reason: kind of failure, e.g. "captcha", "empty" or "error"
+        Returns:
+            backoff in seconds before the session makes its next request
+        """
+        bucket = self._bucket(key)
+        bucket.failures[reason] = bucket.failures.get(reason, 0) + 1
+        bucket.consecutive_failures += 1
+        bucket.rate = max(self.min_rate, bucket.rate * self.decrease)
+
+        delay = min(self.max_backoff, self.base_backoff * 2 ** (bucket.consecutive_failures - 1))
+        delay = delay / 2 + random.uniform(0, delay / 2)
+        bucket.backoff_until = time.monotonic() + delay
+        print(
+            f"Session {key}: {reason}, backing off {delay:.1f}s, "
+            f"rate now {bucket.rate:.2f} requests/s"
+        )
+        return delay
+
+    def metrics(self):
+        """
+        Get the current state of every session
+        Returns:
+            dict mapping each session to its rate (requests/s), available tokens, number of
+            successes, failures per reason and remaining backoff in seconds
+        """
+        now = time.monotonic()
+        return {
+            key: {
+                "rate": bucket.rate,
+                "tokens": bucket.tokens,
+                "successes": bucket.successes,
+                "failures": dict(bucket.failures),
+                "backoff_seconds_left": max(0.0, bucket.backoff_until - now),
+            }
+            for key, bucket in self._buckets.items()
+        }
@@ -0,0 +1,183 @@
+import argparse
+import datetime
+import io
+import json
+import logging
+import os
+
+import zstandard
+
+DEFAULT_ARCHIVE_ROOT = "raw_archive"
+# Uncompressed bytes after which a new archive file is started
+DEFAULT_MAX_FILE_BYTES = 256 * 1024 * 1024
+PARTITION_PREFIX = "crawl_date="
+FILE_SUFFIX = ".jsonl.zst"
+# Payloads after which the current zstd frame is ended, so a killed crawler loses at most these
+DEFAULT_FRAME_PAYLOADS = 1000
+
+LOG = logging.getLogger("reclaim_tiktok")
+
+
+class RawArchive:
+    """
+    Archive of the raw TikTok video payloads (video.as_dict) as zstd-compressed JSON lines
+
+    Files are partitioned by crawl date and rotated once they exceed max_file_bytes:
+        <root>/crawl_date=2024-05-06/part-<HHMMSS>-<pid>-<n>.jsonl.zst
+    Every writer process creates its own files, so several crawlers can archive at once.
+    Each file is a sequence of zstd frames of frame_payloads payloads: a file left unfinished
+    by a killed crawler can be read up to its last complete frame.
+    """
+
+    def __init__(
+        self,
+        root=DEFAULT_ARCHIVE_ROOT,
+        max_file_bytes=DEFAULT_MAX_FILE_BYTES,
+        level=3,
+        frame_payloads=DEFAULT_FRAME_PAYLOADS,
+    ):
+        """
+        Initialize the archive
+        Args:
+            root: directory of the archive (created if it does not exist)
+            max_file_bytes: uncompressed bytes after which a new file is started
+            level: zstd compression level
+            frame_payloads: payloads after which the current zstd frame is ended and written
+        """
+        self.root = root
+        self.max_file_bytes = max_file_bytes
+        self.frame_payloads = frame_payloads
+        self.compressor = zstandard.ZstdCompressor(level=level)
+
+        self._file = None
+        self._writer = None
+        self._file_date = None
+        self._file_bytes = 0
+        self._file_number = 0
+        self._frame_payloads = 0
+
+    def write(self, payload):
+        """
+        Append a raw video payload to the archive
+        Args:
+            payload: video dictionary (TikTokApi video.as_dict)
+        """
+        today = datetime.date.today()
+        if (
+            self._writer is None
+            or today != self._file_date
+            or self._file_bytes >= self.max_file_bytes
+        ):
+            self._rotate(today)
+
+        line = (json.dumps(payload, ensure_ascii=False) + "\n").encode("utf-8")
+        self._writer.write(line)
+        self._file_bytes += len(line)
+        self._frame_payloads += 1
+        if self._frame_payloads >= self.frame_payloads:
+            self._writer.flush(zstandard.FLUSH_FRAME)
+            self._frame_payloads = 0
+
+    def close(self):
+        """Finish the current archive file"""
+        if self._writer is not None:
+            self._writer.close()
+            self._file.close()
+            self._writer = None
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _rotate(self, date):
+        self.close()
+        partition = os.path.join(self.root, f"{PARTITION_PREFIX}{date.isoformat()}")
+        os.makedirs(partition, exist_ok=True)
+
+        self._file_number += 1
+        file_name = (
+            f"part-{datetime.datetime.now():%H%M%S}-{os.getpid()}-{self._file_number}{FILE_SUFFIX}"
+        )
+        self._file = open(os.path.join(partition, file_name), "wb")
+        self._writer = self.compressor.stream_writer(self._file, closefd=False)
+        self._file_date = date
+        self._file_bytes = 0
+        self._frame_payloads = 0
+
+    def iter_payloads(self, start_date=None, end_date=None):
+        """
+        Read the raw video payloads back, partition by partition in date order
+        The truncated end of a file that was not finished (killed crawler) is skipped with a
+        warning.
+        Args:
+            start_date: first crawl date (datetime.date) to read, all if None
+            end_date: last crawl date (datetime.date) to read, all if None
+        Yields:
+            video dictionaries
+        """
+        if not os.path.isdir(self.root):
+            return
+
+        for partition in sorted(os.listdir(self.root)):
+            if not partition.startswith(PARTITION_PREFIX):
+                continue
+            date = datetime.date.fromisoformat(partition[len(PARTITION_PREFIX) :])
+            if (start_date and date < start_date) or (end_date and date > end_date):
+                continue
+
+            partition_path = os.path.join(self.root, partition)
+            for file_name in sorted(os.listdir(partition_path)):
+                if not file_name.endswith(FILE_SUFFIX):
+                    continue
+                yield from _iter_file_payloads(os.path.join(partition_path, file_name))
+
+
+def _iter_file_payloads(path):
+    """
+    Read the raw video payloads of one archive file, up to its truncated end if any
+    Args:
+        path: path of the archive file
+    Yields:
+        video dictionaries
+    """
+    read = 0
+    with open(path, "rb") as f:
+        reader = zstandard.ZstdDecompressor().stream_reader(f, read_across_frames=True)
+        try:
+            for line in io.TextIOWrapper(reader, encoding="utf-8"):
+                if line.strip():
+                    payload = json.loads(line)
+                    read += 1
+                    yield payload
+        except (zstandard.ZstdError, UnicodeDecodeError, json.JSONDecodeError) as e:
+            LOG.warning("Skipping the truncated end of %s after %d payloads: %s", path, read, e)
+
+
+def main():
+    """Command line entry point: replay an archive into the SQL database"""
+    from reclaim_tiktok.scrapping.scrapper import Scrapper
+
+    parser = argparse.ArgumentParser(
+        description="Re-run process_video and the database ingest on archived raw payloads"
+    )
+    parser.add_argument("connection_str", help="connection string to the SQL database")
+    parser.add_argument("--root", default=DEFAULT_ARCHIVE_ROOT, help="archive directory")
+    parser.add_argument("--start-date", type=datetime.date.fromisoformat, default=None)
+    parser.add_argument("--end-date", type=datetime.date.fromisoformat, default=None)
+    parser.add_argument("--batch-size", type=int, default=1000)
+    args = parser.parse_args()
+
+    Scrapper(ms_token=None).replay_archive(
+        RawArchive(args.root),
+        args.connection_str,
+        start_date=args.start_date,
+        end_date=args.end_date,
+        batch_size=args.batch_size,
+    )
+
+
+if __name__ == "__main__":
+    main()
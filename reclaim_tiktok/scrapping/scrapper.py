@@ -1,31 +1,258 @@
+import asyncio
+import contextlib
 import datetime
 import time
 
 import nest_asyncio
 import pyodbc
-from TikTokApi import TikTokApi
+from TikTokApi.exceptions import CaptchaException, EmptyResponseException, InvalidResponseException
+
+from reclaim_tiktok.scrapping.checkpoint_store import CheckpointStore
+from reclaim_tiktok.scrapping.known_id_index import KnownIdIndex
+from reclaim_tiktok.scrapping.rate_limiter import AdaptiveRateLimiter
+from reclaim_tiktok.scrapping.raw_archive import RawArchive
+from reclaim_tiktok.scrapping.seen_filter import BloomFilter, SeenIds
+from reclaim_tiktok.scrapping.session_pool import SessionPool
 
 nest_asyncio.apply()
 
+# Marks the end of a stream of videos passed through an asyncio.Queue
+_STREAM_DONE = object()
+
+CRAWL_MODES = ("full", "resume", "incremental")
+# Save the crawl position every page of videos
+CHECKPOINT_EVERY = 30
+# Incremental crawls stop after this many already known videos in a row
+INCREMENTAL_PATIENCE = 30
+
+# Number of videos TikTok returns per feed request
+TIKTOK_PAGE_SIZE = 35
+# Responses that mean TikTok is throttling the session
+THROTTLING_ERRORS = (CaptchaException, EmptyResponseException, InvalidResponseException)
+# Number of times a throttled feed is retried from its cursor
+MAX_RETRIES = 5
+
+# Number of rows sent to the database per round trip
+DEFAULT_BATCH_SIZE = 1000
+# SQL Server accepts at most 2100 parameters per statement
+MAX_QUERY_PARAMETERS = 2000
+
+# Kinds of the KnownIdIndex per SQL table
+INDEX_KINDS = {"dbo.Videos": "videos", "dbo.Users": "users", "dbo.Sounds": "sounds"}
+
+USER_COLUMNS = (
+    "id",
+    "unique_name_id",
+    "nickname",
+    "follower_count",
+    "following_count",
+    "heart_count",
+    "video_count",
+    "digg_count",
+    "verified",
+)
+SOUND_COLUMNS = ("id", "title", "original_sound", "album", "author_name", "url")
+VIDEO_COLUMNS = (
+    "id",
+    "timestamp_upload",
+    "timestamp_db",
+    "duration",
+    "digg_count",
+    "share_count",
+    "comment_count",
+    "play_count",
+    "description",
+    "is_ad",
+    "author_id",
+    "suggested_words",
+    "url",
+    "transcript_en",
+    "transcript_de",
+    "sound_id",
+    "removed",
+    "has_transcript",
+    "no_transcript_reason",
+    "core_messages_de",
+)
+
+STATS_HISTORY_COLUMNS = (
+    "video_id",
+    "snapshot_time",
+    "play_count",
+    "digg_count",
+    "share_count",
+    "comment_count",
+)
+CREATE_STATS_HISTORY_TABLE = """
+IF OBJECT_ID('dbo.VideoStatsHistory', 'U') IS NULL
+CREATE TABLE dbo.VideoStatsHistory (
+    video_id BIGINT NOT NULL,
+    snapshot_time DATETIME2(0) NOT NULL,
+    play_count BIGINT NOT NULL,
+    digg_count BIGINT NOT NULL,
+    share_count BIGINT NOT NULL,
+    comment_count BIGINT NOT NULL,
+    PRIMARY KEY (video_id, snapshot_time)
+)
+"""
+
+
+class CrawlError(Exception):
+    """Raised at the end of a concurrent crawl when some of its hashtags/users failed"""
+
+    def __init__(self, errors, videos=None):
+        """
+        Initialize the error
+        Args:
+            errors: dict mapping the failed hashtags/users to their exception
+            videos: videos crawled nevertheless, if the crawl collected them
+        """
+        super().__init__(
+            f"Crawling {len(errors)} target(s) failed: "
+            + ", ".join(f"{target} ({error})" for target, error in errors.items())
+        )
+        self.errors = errors
+        self.videos = videos
+
+
+def _throttling_reason(error):
+    """Name the kind of throttling behind a TikTokApi exception for the rate limiter"""
+    if isinstance(error, CaptchaException):
+        return "captcha"
+    if isinstance(error, EmptyResponseException):
+        return "empty"
+    return "invalid"
+
+
+class _FeedPosition:
+    """Position of the crawl of a hashtag or user feed, advanced after every video"""
+
+    def __init__(self, kind, key, cursor=0, watermark=None):
+        """
+        Initialize the position
+        Args:
+            kind: "hashtag" or "user"
+            key: the hashtag or username
+            cursor: cursor of the next video (offset for hashtags, createTime in ms for users)
+            watermark: newest createTime of the previous crawl, for incremental user crawls
+        """
+        self.kind = kind
+        self.key = key
+        self.cursor = cursor
+        self.watermark = watermark
+        self.newest_create_time = None
+        self.seen = 0
+        self.duplicates = 0
+        self.known_in_a_row = 0
+
+    def advance(self, attempt_cursor, attempt_seen, create_time):
+        """
+        Move past a video of the current feed request
+        Args:
+            attempt_cursor: cursor the feed request started from
+            attempt_seen: number of videos of the feed request so far, including this one
+            create_time: createTime of the video (None if missing)
+        Returns:
+            True once an incremental crawl reached INCREMENTAL_PATIENCE known videos in a row
+        """
+        self.seen += 1
+        if self.kind == "hashtag":
+            self.cursor = attempt_cursor + attempt_seen
+        elif create_time:
+            self.cursor = create_time * 1000
+        if create_time:
+            self.newest_create_time = max(self.newest_create_time or 0, create_time)
+
+        if self.watermark and create_time and create_time <= self.watermark:
+            self.known_in_a_row += 1
+            return self.known_in_a_row >= INCREMENTAL_PATIENCE
+        self.known_in_a_row = 0
+        return False
+
 
 class Scrapper:
-    def __init__(self, ms_token):
+    def __init__(
+        self,
+        ms_token,
+        checkpoint_store: CheckpointStore = None,
+        crawl_mode="full",
+        session_pool: SessionPool = None,
+        headless=False,
+        known_id_index: KnownIdIndex = None,
+        rate_limiter: AdaptiveRateLimiter = None,
+        raw_archive: RawArchive = None,
+        seen_filter: SeenIds | BloomFilter = None,
+    ):
         """
         Initialize the scrapper
+        The TikTok sessions are kept alive between calls, call close() (or use the scrapper as
+        an async context manager) to shut the browser down.
         Args:
             ms_token: token to access the TikTok API - can be found in browser cookies
+            checkpoint_store: CheckpointStore recording the crawl position per hashtag/user
+            crawl_mode: "full" starts every hashtag/user from the beginning,
+                "resume" continues unfinished crawls from their last checkpoint,
+                "incremental" additionally stops paging user feeds once it reaches videos that
+                are not newer than the newest video of the previous crawl; hashtag feeds are
+                not ordered by time, so for them it behaves like "resume"
+            session_pool: SessionPool to share the browser sessions with other scrappers
+            headless: run the browser of the default session pool without a window
+            known_id_index: KnownIdIndex consulted before asking the SQL database whether an id
+                is new; videos found in it are skipped by the filters and streaming crawls
+            rate_limiter: AdaptiveRateLimiter pacing the requests of every session
+                (see rate_limiter.metrics() for the current rates)
+            raw_archive: RawArchive every raw video payload of a crawl is written to
+            seen_filter: SeenIds or BloomFilter (see seen_filter.make_seen_filter) shared by
+                the hashtags/users of a crawl; videos already in it are dropped while crawling
+                and the overlap per (kind, hashtag/user) is recorded in overlap_stats. It is
+                reset at the start of every search_* and aiter_* call
         """
+        if crawl_mode not in CRAWL_MODES:
+            raise ValueError(f"crawl_mode must be one of {CRAWL_MODES}")
+        if crawl_mode != "full" and checkpoint_store is None:
+            raise ValueError(f"crawl_mode '{crawl_mode}' requires a checkpoint_store")
+
         self.ms_token = ms_token
+        self.checkpoint_store = checkpoint_store
+        self.crawl_mode = crawl_mode
+        self.session_pool = session_pool or SessionPool(headless=headless)
+        self.known_id_index = known_id_index
+        self.rate_limiter = rate_limiter or AdaptiveRateLimiter()
+        self.raw_archive = raw_archive
+        self.seen_filter = seen_filter
+        self.overlap_stats = {}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def close(self):
+        """Close the TikTok sessions and the browser and finish the raw archive file"""
+        await self.session_pool.close()
+        if self.raw_archive:
+            self.raw_archive.close()
 
     def update_ms_token(self, ms_token):
         """
         Update the ms_token
+        The sessions are recycled with the new token on the next call.
         Args:
             ms_token: token to access the TikTok API - can be found in browser cookies
         """
         self.ms_token = ms_token
 
-    async def search_videos_by_hashtags(self, count=10, hashtags=[], videos=[]):
+    def reset_seen_filter(self):
+        """
+        Forget the videos seen so far and their overlap stats, so that the next crawl does not
+        drop them as duplicates
+        """
+        if self.seen_filter is not None:
+            self.seen_filter.clear()
+        self.overlap_stats = {}
+
+    async def search_videos_by_hashtags(self, count=10, hashtags=None, videos=None):
         """
         Search for videos by hashtags
         Args:
@@ -37,19 +264,20 @@ class Scrapper:
         """
         if not hashtags:
             raise ValueError("No hashtags provided")
+        if videos is None:
+            videos = []
+        self.reset_seen_filter()
 
-        async with TikTokApi() as api:
-            await api.create_sessions(
-                ms_tokens=[self.ms_token], num_sessions=1, sleep_after=3, headless=False
-            )
-
+        api = await self.session_pool.acquire([self.ms_token])
+        try:
             for hashtag in hashtags:
-                print(f"Searching for {hashtag}")
-                tag = api.hashtag(name=hashtag)
-                async for video in tag.videos(count=count, cursor=0):
-                    # print(video)
+                async for video in self._iter_hashtag_videos(api, hashtag, count):
                     videos.append(video)
-                    # print(video.as_dict)
+        except Exception:
+            self.session_pool.mark_unhealthy()
+            raise
+        finally:
+            await self.session_pool.release()
 
         return videos
 
@@ -66,25 +294,172 @@ class Scrapper:
             raise ValueError("No user_name provided")
 
         user_infos = []
-        async with TikTokApi() as api:
-            await api.create_sessions(
-                ms_tokens=[self.ms_token], num_sessions=1, sleep_after=3, headless=False
-            )
-
+        api = await self.session_pool.acquire([self.ms_token])
+        try:
             for user_name in user_names:
                 print(f"Searching for {user_name}")
+                await self.rate_limiter.acquire()
                 try:
                     user = api.user(user_name)
                     user_info = await user.info()
                     user_infos.append(user_info)
+                    self.rate_limiter.report_success()
                 except KeyError as e:
                     print(e)
                     user_info = None
                     user_infos.append(user_info)
+        except Exception:
+            self.session_pool.mark_unhealthy()
+            raise
+        finally:
+            await self.session_pool.release()
 
         return user_infos
 
-    async def search_videos_by_users(self, count=10, users=[], videos=[]):
+    async def get_user_info_by_username_concurrent(
+        self,
+        user_names=None,
+        max_concurrency=8,
+        timeout=30,
+        ms_tokens=None,
+        num_sessions=None,
+        connection_str=None,
+        batch_size=100,
+    ):
+        """
+        Search for users by username, several at a time
+        Args:
+            user_names: list of usernames to search for
+            max_concurrency: maximum number of lookups at the same time
+            timeout: seconds after which a single lookup counts as failed
+            ms_tokens: pool of ms_tokens to create the sessions with (defaults to [self.ms_token])
+            num_sessions: number of TikTokApi sessions to create (defaults to len(ms_tokens))
+            connection_str: if given, found users are added to the SQL database in batches by
+                a single writer; the lookups pause while it is two batches behind
+            batch_size: number of found users added to the database at once
+        Returns:
+            user_infos: list of user_infos in the order of user_names (None if not found/failed)
+            not_found: list of usernames that do not exist
+            errors: dict mapping usernames whose lookup failed to the error message
+            db_errors: list of the error messages of the database batches that failed (their
+                users are still in user_infos)
+        """
+        if not user_names:
+            raise ValueError("No user_name provided")
+
+        ms_tokens = ms_tokens or [self.ms_token]
+        num_sessions = num_sessions or len(ms_tokens)
+        api = await self.session_pool.acquire(ms_tokens, num_sessions)
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        user_infos = [None] * len(user_names)
+        not_found = []
+        errors = {}
+        db_errors = []
+        pending_db_users = []
+        db_batches = asyncio.Queue(maxsize=2)
+
+        async def flush_to_db():
+            nonlocal pending_db_users
+            batch, pending_db_users = pending_db_users, []
+            if connection_str and batch:
+                await db_batches.put(batch)
+
+        async def lookup(index, user_name):
+            async with semaphore:
+                user_info = await self._lookup_user(
+                    api, user_name, index % num_sessions, timeout, not_found, errors
+                )
+            if user_info is None:
+                return
+            user_infos[index] = user_info
+            pending_db_users.append(user_info)
+            if len(pending_db_users) >= batch_size:
+                await flush_to_db()
+
+        writer = None
+        if connection_str:
+            writer = asyncio.create_task(
+                self._write_users_to_db(db_batches, connection_str, db_errors)
+            )
+        try:
+            await asyncio.gather(*(lookup(index, name) for index, name in enumerate(user_names)))
+            await flush_to_db()
+        except BaseException:
+            if writer:
+                writer.cancel()
+                await asyncio.gather(writer, return_exceptions=True)
+            raise
+        finally:
+            await self.session_pool.release()
+        if writer:
+            await db_batches.put(_STREAM_DONE)
+            await writer
+
+        print(
+            f"Found {len(user_names) - len(not_found) - len(errors)} users, "
+            f"{len(not_found)} not found, {len(errors)} failed"
+        )
+        if db_errors:
+            print(f"{len(db_errors)} database batches failed")
+        return user_infos, not_found, errors, db_errors
+
+    async def _lookup_user(self, api, user_name, session_index, timeout, not_found, errors):
+        """
+        Look a user up by username, recording why if it is not found or fails
+        Args:
+            api: TikTokApi instance
+            user_name: username to search for
+            session_index: index of the session to use
+            timeout: seconds after which the lookup counts as failed
+            not_found: list the username is appended to if it does not exist
+            errors: dict the error message of a failed lookup is stored in
+        Returns:
+            user_info, or None if the user was not found or the lookup failed
+        """
+        print(f"Searching for {user_name}")
+        await self.rate_limiter.acquire(session_index)
+        try:
+            user_info = await asyncio.wait_for(
+                api.user(user_name).info(session_index=session_index), timeout
+            )
+        except KeyError:
+            # TikTok answers unknown usernames without user data
+            self.rate_limiter.report_success(session_index)
+            not_found.append(user_name)
+            return None
+        except THROTTLING_ERRORS as e:
+            self.rate_limiter.report_failure(session_index, _throttling_reason(e))
+            errors[user_name] = str(e)
+            return None
+        except asyncio.TimeoutError:
+            errors[user_name] = f"Timed out after {timeout}s"
+            return None
+        except Exception as e:
+            errors[user_name] = str(e)
+            return None
+        self.rate_limiter.report_success(session_index)
+        return user_info
+
+    async def _write_users_to_db(self, db_batches, connection_str, db_errors):
+        """
+        Add the batches of user_infos of a queue to the SQL database, one at a time, until the
+        end of stream sentinel
+        Args:
+            db_batches: asyncio.Queue of lists of user_infos
+            connection_str: connection string to the SQL database
+            db_errors: list the error messages of failed batches are appended to
+        """
+        while (batch := await db_batches.get()) is not _STREAM_DONE:
+            try:
+                await asyncio.to_thread(
+                    self.add_users_to_db_from_list_of_user_info, batch, connection_str
+                )
+            except Exception as e:
+                print(f"Adding {len(batch)} users to the database failed: {e}")
+                db_errors.append(str(e))
+
+    async def search_videos_by_users(self, count=10, users=None, videos=None):
         """
         Search for videos by users
         Args:
@@ -96,28 +471,713 @@ class Scrapper:
         """
         if not users:
             raise ValueError("No hashtags provided")
+        if videos is None:
+            videos = []
+        self.reset_seen_filter()
+
+        api = await self.session_pool.acquire([self.ms_token])
+        try:
+            for user in users:
+                async for video in self._iter_user_videos(api, user, count):
+                    videos.append(video)
+        except Exception:
+            self.session_pool.mark_unhealthy()
+            raise
+        finally:
+            await self.session_pool.release()
+
+        return videos
+
+    async def search_videos_by_hashtags_concurrent(
+        self, count=10, hashtags=None, ms_tokens=None, num_sessions=None, max_concurrency=None
+    ):
+        """
+        Search for videos by hashtags, fanning the hashtags out over several sessions
+        Args:
+            count: number of videos to search for per hashtag
+            hashtags: list of hashtags to search for
+            ms_tokens: pool of ms_tokens to create the sessions with (defaults to [self.ms_token])
+            num_sessions: number of TikTokApi sessions to create (defaults to len(ms_tokens))
+            max_concurrency: maximum number of hashtags crawled at the same time
+                (at least num_sessions, defaults to num_sessions)
+        Returns:
+            list of videos (TikTokApi video objects), in the order of the hashtags
+        Raises:
+            CrawlError: if some hashtags failed, after the others are crawled
+        """
+        if not hashtags:
+            raise ValueError("No hashtags provided")
+
+        return await self._crawl_concurrently(
+            hashtags, self._iter_hashtag_videos, count, ms_tokens, num_sessions, max_concurrency
+        )
 
-        async with TikTokApi() as api:
-            await api.create_sessions(
-                ms_tokens=[self.ms_token], num_sessions=1, sleep_after=3, headless=False
+    async def search_videos_by_users_concurrent(
+        self, count=10, users=None, ms_tokens=None, num_sessions=None, max_concurrency=None
+    ):
+        """
+        Search for videos by users, fanning the users out over several sessions
+        Args:
+            count: number of videos to search for per user
+            users: list of users to search for
+            ms_tokens: pool of ms_tokens to create the sessions with (defaults to [self.ms_token])
+            num_sessions: number of TikTokApi sessions to create (defaults to len(ms_tokens))
+            max_concurrency: maximum number of users crawled at the same time
+                (at least num_sessions, defaults to num_sessions)
+        Returns:
+            list of videos (TikTokApi video objects), in the order of the users
+        Raises:
+            CrawlError: if some users failed, after the others are crawled
+        """
+        if not users:
+            raise ValueError("No users provided")
+
+        return await self._crawl_concurrently(
+            users, self._iter_user_videos, count, ms_tokens, num_sessions, max_concurrency
+        )
+
+    async def aiter_videos_by_hashtags(
+        self,
+        count=10,
+        hashtags=None,
+        ms_tokens=None,
+        num_sessions=None,
+        max_concurrency=None,
+        max_queue_size=1000,
+    ):
+        """
+        Stream processed videos by hashtags as they arrive
+        Args:
+            count: number of videos to search for per hashtag
+            hashtags: list of hashtags to search for
+            ms_tokens: pool of ms_tokens to create the sessions with (defaults to [self.ms_token])
+            num_sessions: number of TikTokApi sessions to create (defaults to len(ms_tokens))
+            max_concurrency: maximum number of hashtags crawled at the same time
+                (at least num_sessions, defaults to num_sessions)
+            max_queue_size: number of videos buffered before the crawl waits for the consumer
+        Yields:
+            processed video dictionaries (see process_video)
+        """
+        if not hashtags:
+            raise ValueError("No hashtags provided")
+
+        async with contextlib.aclosing(
+            self._stream_concurrently(
+                hashtags,
+                self._iter_hashtag_videos,
+                count,
+                ms_tokens,
+                num_sessions,
+                max_concurrency,
+                max_queue_size,
             )
+        ) as videos:
+            async for _, video in videos:
+                if self._is_known_video(video):
+                    continue
+                yield self.process_video(video.as_dict)
+
+    async def aiter_videos_by_users(
+        self,
+        count=10,
+        users=None,
+        ms_tokens=None,
+        num_sessions=None,
+        max_concurrency=None,
+        max_queue_size=1000,
+    ):
+        """
+        Stream processed videos by users as they arrive
+        Args:
+            count: number of videos to search for per user
+            users: list of users to search for
+            ms_tokens: pool of ms_tokens to create the sessions with (defaults to [self.ms_token])
+            num_sessions: number of TikTokApi sessions to create (defaults to len(ms_tokens))
+            max_concurrency: maximum number of users crawled at the same time
+                (at least num_sessions, defaults to num_sessions)
+            max_queue_size: number of videos buffered before the crawl waits for the consumer
+        Yields:
+            processed video dictionaries (see process_video)
+        """
+        if not users:
+            raise ValueError("No users provided")
+
+        async with contextlib.aclosing(
+            self._stream_concurrently(
+                users,
+                self._iter_user_videos,
+                count,
+                ms_tokens,
+                num_sessions,
+                max_concurrency,
+                max_queue_size,
+            )
+        ) as videos:
+            async for _, video in videos:
+                if self._is_known_video(video):
+                    continue
+                yield self.process_video(video.as_dict)
 
-            for user in users:
-                user_tag = api.user(user)
-                print(f"Searching for {user}")
+    async def stream_videos_to_db(
+        self, processed_videos, connection_str, batch_size=500, max_queue_size=1000
+    ):
+        """
+        Consume a stream of processed videos and add them to the SQL database in batches
+        The database inserts run in a worker thread, so the crawl keeps producing while a batch
+        is written. The bounded queue pauses the crawl when the database falls behind. If the
+        crawl fails, the videos crawled before are written and its error is raised.
+        Args:
+            processed_videos: async iterable of processed videos (e.g. aiter_videos_by_hashtags)
+            connection_str: connection string to the SQL database
+            batch_size: number of videos written to the database at once
+            max_queue_size: number of videos buffered between the crawl and the database
+        Returns:
+            number of videos handed to the database
+        """
+        if not connection_str:
+            raise ValueError("No connection string provided")
 
+        queue = asyncio.Queue(maxsize=max_queue_size)
+
+        async def produce():
+            try:
+                async for video in processed_videos:
+                    await queue.put(video)
+            except asyncio.CancelledError:
+                # the consumer failed and the queue may be full: no sentinel
+                raise
+            except Exception:
+                await queue.put(_STREAM_DONE)
+                raise
+            await queue.put(_STREAM_DONE)
+
+        producer = asyncio.create_task(produce())
+        total = 0
+        batch = {}
+        try:
+            while True:
+                video = await queue.get()
+                if video is not _STREAM_DONE:
+                    # the same video often shows up under several hashtags
+                    batch[video["video_id"]] = video
+                if batch and (len(batch) >= batch_size or video is _STREAM_DONE):
+                    await asyncio.to_thread(
+                        self.ingest_batch, list(batch.values()), connection_str, batch_size
+                    )
+                    total += len(batch)
+                    batch = {}
+                if video is _STREAM_DONE:
+                    break
+        except BaseException:
+            producer.cancel()
+            await asyncio.gather(producer, return_exceptions=True)
+            raise
+        # re-raises the error of a failed crawl once the videos before it are written
+        await producer
+
+        return total
+
+    def create_stats_history_table(self, connection_str):
+        """
+        Create the table storing the engagement stats snapshots, if it does not exist
+        Args:
+            connection_str: connection string to the SQL database
+        """
+        if not connection_str:
+            raise ValueError("No connection string provided")
+
+        with pyodbc.connect(connection_str) as cnxn:
+            cursor = cnxn.cursor()
+            cursor.execute(CREATE_STATS_HISTORY_TABLE)
+            cnxn.commit()
+
+    async def refresh_video_stats(
+        self,
+        connection_str,
+        min_age_days=0,
+        max_age_days=14,
+        limit=1000,
+        max_concurrency=4,
+        batch_size=100,
+    ):
+        """
+        Re-poll the engagement stats of already ingested videos and append them as snapshots to
+        dbo.VideoStatsHistory
+        Videos uploaded between min_age_days and max_age_days ago are refreshed fastest-growing
+        first: by plays per minute between their last two snapshots, or since upload if they
+        have fewer than two. Snapshots whose play count did not change are not stored.
+        Args:
+            connection_str: connection string to the SQL database
+            min_age_days: only refresh videos uploaded at least this many days ago
+            max_age_days: only refresh videos uploaded at most this many days ago
+            limit: maximum number of videos refreshed in this run
+            max_concurrency: maximum number of stats lookups at the same time
+            batch_size: number of videos looked up before their snapshots are written
+        Returns:
+            number of snapshots added
+        """
+        if not connection_str:
+            raise ValueError("No connection string provided")
+
+        candidates = await asyncio.to_thread(
+            self._get_stats_refresh_candidates, connection_str, min_age_days, max_age_days, limit
+        )
+        print("Number of videos to refresh", len(candidates))
+
+        api = await self.session_pool.acquire([self.ms_token])
+        num_sessions = self.session_pool.num_sessions
+        semaphore = asyncio.Semaphore(max_concurrency)
+        failed = 0
+
+        async def lookup(candidate, session_index):
+            nonlocal failed
+            async with semaphore:
+                await self.rate_limiter.acquire(session_index)
                 try:
-                    info = await user_tag.info()
-                except Exception:
-                    print(f"User {user} not found")
-                    continue
-                print(info)
-                async for video in user_tag.videos(count=count, cursor=0):
-                    # print(video)
-                    videos.append(video)
-                    # print(video.as_dict)
+                    info = await api.video(url=candidate.url).info(session_index=session_index)
+                except THROTTLING_ERRORS as e:
+                    self.rate_limiter.report_failure(session_index, _throttling_reason(e))
+                    failed += 1
+                    return None
+                except Exception as e:
+                    print(f"Refreshing video {candidate.id} failed: {e}")
+                    failed += 1
+                    return None
+                self.rate_limiter.report_success(session_index)
+
+            stats = info.get("statsV2") or info.get("stats") or {}
+            play_count = int(stats.get("playCount", 0))
+            if play_count == candidate.last_play_count:
+                return None
+            return (
+                int(candidate.id),
+                datetime.datetime.now(),
+                play_count,
+                int(stats.get("diggCount", 0)),
+                int(stats.get("shareCount", 0)),
+                int(stats.get("commentCount", 0)),
+            )
 
-        return videos
+        added = 0
+        try:
+            for i in range(0, len(candidates), batch_size):
+                batch = candidates[i : i + batch_size]
+                snapshots = await asyncio.gather(
+                    *(
+                        lookup(candidate, index % num_sessions)
+                        for index, candidate in enumerate(batch)
+                    )
+                )
+                snapshots = [snapshot for snapshot in snapshots if snapshot]
+                if snapshots:
+                    await asyncio.to_thread(self._add_stats_snapshots, snapshots, connection_str)
+                added += len(snapshots)
+        finally:
+            await self.session_pool.release()
+
+        print(f"Added {added} stats snapshots, {failed} lookups failed")
+        return added
+
+    def _get_stats_refresh_candidates(self, connection_str, min_age_days, max_age_days, limit):
+        """
+        Get the videos to refresh, fastest-growing first
+        Args:
+            connection_str: connection string to the SQL database
+            min_age_days: only videos uploaded at least this many days ago
+            max_age_days: only videos uploaded at most this many days ago
+            limit: maximum number of videos
+        Returns:
+            list of pyodbc.Row with id, url and last_play_count (None without snapshot)
+        """
+        query = """
+        WITH ranked AS (
+            SELECT video_id, snapshot_time, play_count,
+                ROW_NUMBER() OVER (PARTITION BY video_id ORDER BY snapshot_time DESC) AS rn
+            FROM dbo.VideoStatsHistory
+        )
+        SELECT TOP (?) v.id, v.url, last.play_count AS last_play_count
+        FROM dbo.Videos v
+        LEFT JOIN ranked last ON last.video_id = v.id AND last.rn = 1
+        LEFT JOIN ranked prev ON prev.video_id = v.id AND prev.rn = 2
+        WHERE v.timestamp_upload
+                BETWEEN DATEADD(day, -?, GETDATE()) AND DATEADD(day, -?, GETDATE())
+            AND (v.removed IS NULL OR v.removed = 0)
+        ORDER BY COALESCE(
+            CAST(last.play_count - prev.play_count AS FLOAT)
+                / NULLIF(DATEDIFF(minute, prev.snapshot_time, last.snapshot_time), 0),
+            CAST(COALESCE(last.play_count, v.play_count) AS FLOAT)
+                / NULLIF(DATEDIFF(minute, v.timestamp_upload, GETDATE()), 0)
+        ) DESC
+        """
+        with pyodbc.connect(connection_str) as cnxn:
+            cursor = cnxn.cursor()
+            cursor.execute(query, limit, max_age_days, min_age_days)
+            return cursor.fetchall()
+
+    def _add_stats_snapshots(self, snapshots, connection_str):
+        """
+        Append stats snapshots to dbo.VideoStatsHistory
+        Args:
+            snapshots: list of tuples in the order of STATS_HISTORY_COLUMNS
+            connection_str: connection string to the SQL database
+        """
+        column_list = ", ".join(STATS_HISTORY_COLUMNS)
+        placeholders = ", ".join("?" * len(STATS_HISTORY_COLUMNS))
+        with pyodbc.connect(connection_str) as cnxn:
+            cursor = cnxn.cursor()
+            cursor.fast_executemany = True
+            cursor.executemany(
+                f"INSERT INTO dbo.VideoStatsHistory ({column_list}) VALUES ({placeholders})",
+                snapshots,
+            )
+            cnxn.commit()
+
+    async def _iter_hashtag_videos(self, api, hashtag, count, session_index=None):
+        """
+        Iterate over the videos of a hashtag
+        Args:
+            api: TikTokApi instance with created sessions
+            hashtag: hashtag to search for
+            count: number of videos to search for
+            session_index: index of the session to use (random if None)
+        Yields:
+            videos (TikTokApi video objects)
+        """
+        print(f"Searching for {hashtag}")
+        tag = api.hashtag(name=hashtag)
+
+        def videos_from(cursor, count):
+            return tag.videos(count=count, cursor=cursor, session_index=session_index)
+
+        async with contextlib.aclosing(
+            self._iter_checkpointed("hashtag", hashtag, count, videos_from, session_index)
+        ) as videos:
+            async for video in videos:
+                yield video
+
+    async def _iter_user_videos(self, api, user, count, session_index=None):
+        """
+        Iterate over the videos of a user
+        Args:
+            api: TikTokApi instance with created sessions
+            user: username to search for
+            count: number of videos to search for
+            session_index: index of the session to use (random if None)
+        Yields:
+            videos (TikTokApi video objects)
+        """
+        print(f"Searching for {user}")
+        user_tag = api.user(user)
+        await self.rate_limiter.acquire(session_index or 0)
+        try:
+            await user_tag.info(session_index=session_index)
+        except THROTTLING_ERRORS as e:
+            self.rate_limiter.report_failure(session_index or 0, _throttling_reason(e))
+            raise
+        except Exception:
+            print(f"User {user} not found")
+            return
+        self.rate_limiter.report_success(session_index or 0)
+
+        def videos_from(cursor, count):
+            return user_tag.videos(count=count, cursor=cursor, session_index=session_index)
+
+        async with contextlib.aclosing(
+            self._iter_checkpointed("user", user, count, videos_from, session_index)
+        ) as videos:
+            async for video in videos:
+                yield video
+
+    async def _iter_checkpointed(self, kind, key, count, videos_from, session_index=None):
+        """
+        Iterate over the videos of a hashtag or user, keeping its checkpoint up to date
+        Hashtag feeds are paged by offset, user feeds by the createTime (in ms) of the oldest
+        video so far, so that is what gets stored as cursor.
+        Every page request waits for the rate limiter of the session. Captchas, empty and
+        invalid responses slow the session down and the feed is retried from its cursor.
+        Args:
+            kind: "hashtag" or "user"
+            key: the hashtag or username
+            count: number of videos to search for
+            videos_from: function (cursor, count) returning the video iterator
+            session_index: index of the session used by videos_from
+        Yields:
+            videos (TikTokApi video objects)
+        """
+        position = self._start_position(kind, key)
+        try:
+            async with contextlib.aclosing(
+                self._iter_feed(position, count, videos_from, session_index or 0)
+            ) as videos:
+                async for video in videos:
+                    # checked and added at once, so concurrent crawls never both yield an id
+                    if self.seen_filter is not None and not self.seen_filter.add(video.id):
+                        # already crawled under another hashtag/user
+                        position.duplicates += 1
+                        continue
+                    if self.raw_archive:
+                        self.raw_archive.write(video.as_dict)
+                    try:
+                        yield video
+                    except BaseException:
+                        # not taken by the consumer: another hashtag/user may still yield it
+                        if self.seen_filter is not None:
+                            self.seen_filter.discard(video.id)
+                        raise
+        except BaseException:
+            # interrupted (error, rate limit, cancelled consumer): keep the position
+            self._save_checkpoint(position)
+            raise
+        finally:
+            self._record_overlap(position)
+        self._save_checkpoint(position, finished=True)
+
+    def _start_position(self, kind, key):
+        """
+        Find where the crawl of a hashtag or user starts, depending on the crawl mode
+        Args:
+            kind: "hashtag" or "user"
+            key: the hashtag or username
+        Returns:
+            _FeedPosition
+        """
+        checkpoint = self.checkpoint_store.get(kind, key) if self.checkpoint_store else None
+        position = _FeedPosition(kind, key)
+        if self.crawl_mode != "full" and checkpoint and checkpoint["cursor"] is not None:
+            position.cursor = checkpoint["cursor"]
+            print(f"Resuming {kind} {key} at cursor {position.cursor}")
+        # only user feeds are ordered by time, old videos can appear anywhere in a hashtag feed
+        if self.crawl_mode == "incremental" and kind == "user" and checkpoint:
+            position.watermark = checkpoint["newest_create_time"]
+        return position
+
+    async def _iter_feed(self, position, count, videos_from, session_key):
+        """
+        Iterate over a feed from its position, pacing and retrying the page requests
+        Args:
+            position: _FeedPosition, advanced after every video
+            count: number of videos to search for
+            videos_from: function (cursor, count) returning the video iterator
+            session_key: key of the session in the rate limiter
+        Yields:
+            videos (TikTokApi video objects)
+        """
+        limiter = self.rate_limiter
+        retries = 0
+        while position.seen < count:
+            await limiter.acquire(session_key)
+            attempt_cursor = position.cursor
+            attempt_seen = 0
+            try:
+                async for video in videos_from(attempt_cursor, count - position.seen):
+                    create_time = video.as_dict.get("createTime")
+                    yield video
+
+                    attempt_seen += 1
+                    reached_known = position.advance(attempt_cursor, attempt_seen, create_time)
+                    if position.seen % CHECKPOINT_EVERY == 0:
+                        self._save_checkpoint(position)
+                    if attempt_seen % TIKTOK_PAGE_SIZE == 0:
+                        # the next video comes from a new request
+                        limiter.report_success(session_key)
+                        await limiter.acquire(session_key)
+                    if reached_known:
+                        print(f"Reached already crawled videos of {position.kind} {position.key}")
+                        break
+            except THROTTLING_ERRORS as e:
+                retries += 1
+                limiter.report_failure(session_key, _throttling_reason(e))
+                if retries > MAX_RETRIES:
+                    raise
+                continue
+            limiter.report_success(session_key)
+            # count reached, feed exhausted or incremental stop
+            break
+
+    def _save_checkpoint(self, position, finished=False):
+        """
+        Save the position of a crawl in the checkpoint store, if there is one
+        Args:
+            position: _FeedPosition
+            finished: the feed was crawled to the end, the next crawl starts from the beginning
+        """
+        if self.checkpoint_store:
+            cursor = None if finished else position.cursor
+            self.checkpoint_store.save(
+                position.kind, position.key, cursor, position.newest_create_time
+            )
+
+    def _record_overlap(self, position):
+        """
+        Record how many videos of a crawl were dropped by the seen filter in overlap_stats
+        Args:
+            position: _FeedPosition at the end of the crawl
+        """
+        if self.seen_filter is None:
+            return
+        seen, duplicates = position.seen, position.duplicates
+        self.overlap_stats[(position.kind, position.key)] = {
+            "videos": seen,
+            "duplicates": duplicates,
+            "overlap": duplicates / seen if seen else 0.0,
+        }
+        if duplicates:
+            print(
+                f"Dropped {duplicates} of {seen} videos of {position.kind} {position.key} "
+                "as duplicates"
+            )
+
+    async def _crawl_concurrently(
+        self, targets, iter_videos, count, ms_tokens, num_sessions, max_concurrency
+    ):
+        """
+        Crawl a list of targets (hashtags or users) over a pool of sessions
+        Args:
+            targets: list of hashtags or users
+            iter_videos: async generator method (api, target, count, session_index)
+            count: number of videos to search for per target
+            ms_tokens: pool of ms_tokens to create the sessions with
+            num_sessions: number of sessions to create
+            max_concurrency: maximum number of targets crawled at the same time
+        Returns:
+            list of videos (TikTokApi video objects), in the order of the targets
+        Raises:
+            CrawlError: once all targets are crawled, if some failed (its videos attribute
+                holds the videos of the others)
+        """
+        # a repeated target is crawled once
+        targets = list(dict.fromkeys(targets))
+        videos_per_target = {target: [] for target in targets}
+        try:
+            async for target, video in self._stream_concurrently(
+                targets, iter_videos, count, ms_tokens, num_sessions, max_concurrency
+            ):
+                videos_per_target[target].append(video)
+        except CrawlError as e:
+            e.videos = [video for target in targets for video in videos_per_target[target]]
+            raise
+
+        return [video for target in targets for video in videos_per_target[target]]
+
+    async def _stream_concurrently(
+        self,
+        targets,
+        iter_videos,
+        count,
+        ms_tokens,
+        num_sessions,
+        max_concurrency,
+        max_queue_size=0,
+    ):
+        """
+        Crawl a list of targets (hashtags or users) over a pool of sessions and yield the videos
+        as they arrive
+        The max_concurrency workers are spread over the sessions, the first sessions getting
+        one more when it does not divide evenly (7 over 4 sessions: 2, 2, 2, 1). They pull the
+        next target from a shared queue, so a session that is slowed down by TikTok simply
+        takes fewer targets. A target given more than once is crawled once. A failing target
+        does not stop the others: its error is recorded in crawl_stats and raised with the
+        errors of all failed targets once the stream ends.
+        Args:
+            targets: list of hashtags or users
+            iter_videos: async generator method (api, target, count, session_index)
+            count: number of videos to search for per target
+            ms_tokens: pool of ms_tokens to create the sessions with
+            num_sessions: number of sessions to create
+            max_concurrency: maximum number of targets crawled at the same time, at least
+                num_sessions (defaults to num_sessions)
+            max_queue_size: number of videos buffered before the workers wait (0 = unbounded)
+        Yields:
+            tuples of (target, video)
+        Raises:
+            CrawlError: after the last video, if some targets failed
+        """
+        ms_tokens = ms_tokens or [self.ms_token]
+        num_sessions = num_sessions or len(ms_tokens)
+        max_concurrency = max_concurrency or num_sessions
+        if max_concurrency < num_sessions:
+            raise ValueError(
+                f"max_concurrency ({max_concurrency}) must be at least num_sessions "
+                f"({num_sessions}), every session needs a worker"
+            )
+        workers_per_session = [
+            max_concurrency // num_sessions + (session_index < max_concurrency % num_sessions)
+            for session_index in range(num_sessions)
+        ]
+
+        pending_targets = asyncio.Queue()
+        for target in dict.fromkeys(targets):
+            pending_targets.put_nowait(target)
+        videos = asyncio.Queue(maxsize=max_queue_size)
+
+        self.crawl_stats = {}
+        failures = {}
+        self.reset_seen_filter()
+
+        # TikTokApi assigns a random token of the pool to every session
+        api = await self.session_pool.acquire(ms_tokens, num_sessions)
+
+        async def worker(session_index):
+            while not pending_targets.empty():
+                target = pending_targets.get_nowait()
+                start = time.perf_counter()
+                found = 0
+                error = None
+                try:
+                    # aclosing: a cancelled crawl still saves the checkpoint of the target
+                    async with contextlib.aclosing(
+                        iter_videos(api, target, count, session_index)
+                    ) as target_videos:
+                        async for video in target_videos:
+                            await videos.put((target, video))
+                            found += 1
+                except Exception as e:
+                    print(f"Crawling {target} failed: {e}")
+                    self.session_pool.mark_unhealthy()
+                    failures[target] = error = e
+                elapsed = time.perf_counter() - start
+                self.crawl_stats[target] = {
+                    "videos": found,
+                    "seconds": elapsed,
+                    "videos_per_second": found / elapsed if elapsed else 0.0,
+                    "session_index": session_index,
+                    "error": str(error) if error else None,
+                }
+                print(
+                    f"Crawled {found} videos for {target} in {elapsed:.1f}s "
+                    f"({self.crawl_stats[target]['videos_per_second']:.2f} videos/s, "
+                    f"session {session_index})"
+                )
+
+        async def run_workers():
+            try:
+                await asyncio.gather(
+                    *(
+                        worker(session_index)
+                        for session_index in range(num_sessions)
+                        for _ in range(workers_per_session[session_index])
+                    )
+                )
+            except asyncio.CancelledError:
+                # the consumer is gone and the queue may be full: no sentinel
+                raise
+            except Exception:
+                await videos.put(_STREAM_DONE)
+                raise
+            await videos.put(_STREAM_DONE)
+
+        crawl = asyncio.create_task(run_workers())
+        try:
+            while (item := await videos.get()) is not _STREAM_DONE:
+                yield item
+            # re-raises the error of a failed crawl
+            await crawl
+            if failures:
+                raise CrawlError(failures)
+        finally:
+            crawl.cancel()
+            await asyncio.gather(crawl, return_exceptions=True)
+            await self.session_pool.release()
 
     def filter_unique_videos(self, videos):
         """
@@ -128,10 +1188,17 @@ class Scrapper:
             list of unique videos
         """
 
+        # Videos that are already in the database are skipped before touching as_dict
+        known_ids = set()
+        if self.known_id_index:
+            known_ids = self.known_id_index.contains("videos", (video.id for video in videos))
+
         # Get unique videos
         seen_ids = set()
         unique_videos = []
         for video in videos:
+            if int(video.id) in known_ids:
+                continue
             video = video.as_dict
             if video["id"] not in seen_ids:
                 unique_videos.append(video)
@@ -147,15 +1214,46 @@ class Scrapper:
             list of unique sound ids videos
         """
 
+        # Sounds that are already in the database are skipped
+        known_ids = set()
+        if self.known_id_index:
+            known_ids = self.known_id_index.contains(
+                "sounds", (video["music"]["id"] for video in videos)
+            )
+
         # Get unique videos
         seen_ids = set()
         unique_videos = []
         for video in videos:
+            if int(video["music"]["id"]) in known_ids:
+                continue
             if video["music"]["id"] not in seen_ids:
                 unique_videos.append(video)
                 seen_ids.add(video["music"]["id"])
         return unique_videos
 
+    def _is_known_video(self, video):
+        """
+        Check if a video is already in the database according to the known id index
+        Args:
+            video: TikTokApi video object
+        Returns:
+            True if the video is known, False if it is new or there is no index
+        """
+        return bool(self.known_id_index) and self.known_id_index.is_known("videos", video.id)
+
+    def _remember_ids(self, processed_videos):
+        """
+        Add the video, author and sound ids of committed processed videos to the known id index
+        Args:
+            processed_videos: list of processed videos that are stored in the database
+        """
+        if not self.known_id_index:
+            return
+        self.known_id_index.add("videos", (video["video_id"] for video in processed_videos))
+        self.known_id_index.add("users", (video["author_id"] for video in processed_videos))
+        self.known_id_index.add("sounds", (video["sound_id"] for video in processed_videos))
+
     def process_video(self, video):
         """
         Function to apply operations to each video dictionary
@@ -211,12 +1309,15 @@ class Scrapper:
         }
         return processed_video
 
-    def add_users_to_db_from_list_of_user_info(self, users=[], connection_str=""):
+    def add_users_to_db_from_list_of_user_info(
+        self, users=[], connection_str="", batch_size=DEFAULT_BATCH_SIZE
+    ):
         """
         Add users to the SQL database
         Args:
             users: list of user_info dictionaries
             connection_str: connection string to the SQL database
+            batch_size: number of rows sent to the database per round trip
         """
 
         # check if there are any users to process
@@ -239,10 +1340,9 @@ class Scrapper:
             users_ids = {int(user["userInfo"]["user"]["id"]) for user in users}
             print("Number of unique user ids to be added to database", len(users_ids))
 
-            # Get all unique user ids from the SQL database
-            cursor.execute("SELECT id FROM dbo.Users")
-            unique_user_ids_sql = {row[0] for row in cursor.fetchall()}
-            print("Number of unique user ids in database", len(unique_user_ids_sql))
+            # Get the user ids that are already in the SQL database
+            unique_user_ids_sql = self._existing_ids(cursor, "dbo.Users", users_ids)
+            print("Number of unique user ids already in database", len(unique_user_ids_sql))
 
             # Determine which user ids need to be added
             unique_user_ids_to_add = users_ids - unique_user_ids_sql
@@ -257,7 +1357,8 @@ class Scrapper:
 
             print("Number of new users to be added to database", len(users_to_add))
 
-            # Add users to SQL database
+            # cast data to correct types
+            rows = []
             for user in users_to_add:
                 stats = user["userInfo"]["stats"]
                 user_id = user["userInfo"]["user"]["id"]
@@ -265,34 +1366,37 @@ class Scrapper:
                 user_name_unique = user["userInfo"]["user"]["uniqueId"]
                 verified = user["userInfo"]["user"]["verified"]
 
-                query = """
-                INSERT INTO dbo.Users
-                (id, unique_name_id, nickname, follower_count, following_count, heart_count, video_count, digg_count, verified)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-                """
-                # cast data to correct types
-                data = (
-                    int(user_id),
-                    str(user_name_unique),
-                    str(user_nickname),
-                    int(stats["followerCount"]),
-                    int(stats["followingCount"]),
-                    int(stats["heart"]),
-                    int(stats["videoCount"]),
-                    int(stats["diggCount"]),
-                    bool(verified),
+                rows.append(
+                    (
+                        int(user_id),
+                        str(user_name_unique),
+                        str(user_nickname),
+                        int(stats["followerCount"]),
+                        int(stats["followingCount"]),
+                        int(stats["heart"]),
+                        int(stats["videoCount"]),
+                        int(stats["diggCount"]),
+                        bool(verified),
+                    )
                 )
-                cursor.execute(query, data)
+
+            # Add users to SQL database
+            self._bulk_insert(cursor, "dbo.Users", USER_COLUMNS, rows, batch_size)
             cnxn.commit()
+            if self.known_id_index:
+                self.known_id_index.add("users", users_ids)
 
             print("Users added to database successfully")
 
-    def add_users_to_db_from_list_of_videos(self, processed_videos, connection_str):
+    def add_users_to_db_from_list_of_videos(
+        self, processed_videos, connection_str, batch_size=DEFAULT_BATCH_SIZE
+    ):
         """
         Add users to the SQL database
         Args:
             processed_videos: list of processed videos
             connection_str: connection string to the SQL database
+            batch_size: number of rows sent to the database per round trip
         """
 
         # check if there are any videos to process
@@ -305,54 +1409,68 @@ class Scrapper:
 
         with pyodbc.connect(connection_str) as cnxn:
             cursor = cnxn.cursor()
+            self._add_users_from_list_of_videos(cursor, processed_videos, batch_size)
+            cnxn.commit()
+            if self.known_id_index:
+                self.known_id_index.add(
+                    "users", (video["author_id"] for video in processed_videos)
+                )
+            print("Users added to database successfully")
 
-            # Make sure only new users get added to the db
-            # Get all unique author ids from the processed videos
-            unique_author_ids = {video["author_id"] for video in processed_videos}
-
-            # Get all unique author ids from the SQL database
-            cursor.execute("SELECT id FROM dbo.Users")
-            unique_author_ids_sql = {row[0] for row in cursor.fetchall()}
+    def _add_users_from_list_of_videos(
+        self, cursor, processed_videos, batch_size=DEFAULT_BATCH_SIZE
+    ):
+        """
+        Add the authors of processed videos to the SQL database without committing
+        Args:
+            cursor: pyodbc cursor (the caller commits)
+            processed_videos: list of processed videos
+            batch_size: number of rows sent to the database per round trip
+        Returns:
+            number of rows inserted into dbo.Users
+        """
 
-            # Determine which author ids need to be added
-            unique_author_ids_to_add = unique_author_ids - unique_author_ids_sql
+        # Make sure only new users get added to the db
+        # Get all unique author ids from the processed videos
+        unique_author_ids = {video["author_id"] for video in processed_videos}
+
+        # Get the author ids that are already in the SQL database
+        unique_author_ids_sql = self._existing_ids(cursor, "dbo.Users", unique_author_ids)
+
+        # Determine which author ids need to be added
+        unique_author_ids_to_add = unique_author_ids - unique_author_ids_sql
+
+        # Filter authors to add
+        authors_to_add = [
+            video for video in processed_videos if video["author_id"] in unique_author_ids_to_add
+        ]
+        print("Number of new users to be added to database", len(authors_to_add))
+
+        rows = [
+            (
+                int(author["author_id"]),
+                str(author["author_username"]),
+                str(author["author_name"]),
+                int(author["author_followercount"]),
+                int(author["author_followingcount"]),
+                int(author["author_heartcount"]),
+                int(author["author_videocount"]),
+                int(author["author_diggcount"]),
+                bool(author["author_verified"]),
+            )
+            for author in authors_to_add
+        ]
 
-            # Filter authors to add
-            authors_to_add = [
-                video
-                for video in processed_videos
-                if video["author_id"] in unique_author_ids_to_add
-            ]
-            print("Number of new users to be added to database", len(authors_to_add))
-
-            # Add authors to SQL database
-            for author in authors_to_add:
-                query = """
-                INSERT INTO dbo.Users
-                (id, unique_name_id, nickname, follower_count, following_count, heart_count, video_count, digg_count, verified)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-                """
-                data = (
-                    int(author["author_id"]),
-                    str(author["author_username"]),
-                    str(author["author_name"]),
-                    int(author["author_followercount"]),
-                    int(author["author_followingcount"]),
-                    int(author["author_heartcount"]),
-                    int(author["author_videocount"]),
-                    int(author["author_diggcount"]),
-                    bool(author["author_verified"]),
-                )
-                cursor.execute(query, data)
-            cnxn.commit()
-            print("Users added to database successfully")
+        # Add authors to SQL database
+        return self._bulk_insert(cursor, "dbo.Users", USER_COLUMNS, rows, batch_size)
 
-    def add_sounds_to_db(self, processed_videos, connection_str):
+    def add_sounds_to_db(self, processed_videos, connection_str, batch_size=DEFAULT_BATCH_SIZE):
         """
         Add sounds to the SQL database
         Args:
             processed_videos: list of processed videos
             connection_str: connection string to the SQL database
+            batch_size: number of rows sent to the database per round trip
         """
         # check if there are any videos to process
         if not processed_videos:
@@ -364,39 +1482,51 @@ class Scrapper:
 
         with pyodbc.connect(connection_str) as cnxn:
             cursor = cnxn.cursor()
+            self._add_sounds(cursor, processed_videos, batch_size)
+            cnxn.commit()
+            if self.known_id_index:
+                self.known_id_index.add(
+                    "sounds", (video["sound_id"] for video in processed_videos)
+                )
 
-            # check for duplicate sounds in processed videos
-            processed_videos = self.filter_unique_sounds(processed_videos)
+            print("Sounds added to database successfully")
 
-            # Get all unique sound ids from the processed videos
-            unique_sound_ids = {
-                video["sound_id"] for video in processed_videos if video["sound_id"]
-            }
+    def _add_sounds(self, cursor, processed_videos, batch_size=DEFAULT_BATCH_SIZE):
+        """
+        Add the sounds of processed videos to the SQL database without committing
+        Args:
+            cursor: pyodbc cursor (the caller commits)
+            processed_videos: list of processed videos
+            batch_size: number of rows sent to the database per round trip
+        Returns:
+            number of rows inserted into dbo.Sounds
+        """
 
-            # Get all unique sound ids from the SQL database
-            cursor.execute("SELECT id FROM dbo.Sounds")
-            unique_sound_ids_sql = {row[0] for row in cursor.fetchall()}
+        # check for duplicate sounds in processed videos
+        processed_videos = self.filter_unique_sounds(processed_videos)
 
-            # Determine which sound ids need to be added
-            unique_sound_ids_to_add = unique_sound_ids - unique_sound_ids_sql
+        # Get all unique sound ids from the processed videos
+        unique_sound_ids = {video["sound_id"] for video in processed_videos if video["sound_id"]}
 
-            # Filter sounds to add
-            sounds_to_add = [
-                video for video in processed_videos if video["sound_id"] in unique_sound_ids_to_add
-            ]
+        # Get the sound ids that are already in the SQL database
+        unique_sound_ids_sql = self._existing_ids(cursor, "dbo.Sounds", unique_sound_ids)
 
-            print("Number of new sounds to be added to database", len(sounds_to_add))
-
-            # Add sounds to SQL database
-            for sound in sounds_to_add:
-                query = """
-                INSERT INTO dbo.Sounds
-                (id, title, original_sound, album, author_name, url)
-                VALUES (?, ?, ?, ?, ?, ?)
-                """
-                title = str(sound["music"]["title"]).strip().replace(" ", "-")
-                url = f"https://www.tiktok.com/music/{title}-{sound['sound_id']}"
-                data = (
+        # Determine which sound ids need to be added
+        unique_sound_ids_to_add = unique_sound_ids - unique_sound_ids_sql
+
+        # Filter sounds to add
+        sounds_to_add = [
+            video for video in processed_videos if video["sound_id"] in unique_sound_ids_to_add
+        ]
+
+        print("Number of new sounds to be added to database", len(sounds_to_add))
+
+        rows = []
+        for sound in sounds_to_add:
+            title = str(sound["music"]["title"]).strip().replace(" ", "-")
+            url = f"https://www.tiktok.com/music/{title}-{sound['sound_id']}"
+            rows.append(
+                (
                     int(sound["sound_id"]),
                     str(sound["music"]["title"]),
                     bool(sound["music"]["original"]),
@@ -404,17 +1534,18 @@ class Scrapper:
                     str(sound["music"]["authorName"]) if "authorName" in sound["music"] else None,
                     url,
                 )
-                cursor.execute(query, data)
-            cnxn.commit()
+            )
 
-            print("Sounds added to database successfully")
+        # Add sounds to SQL database
+        return self._bulk_insert(cursor, "dbo.Sounds", SOUND_COLUMNS, rows, batch_size)
 
-    def add_videos_to_db(self, processed_videos, connection_str):
+    def add_videos_to_db(self, processed_videos, connection_str, batch_size=DEFAULT_BATCH_SIZE):
         """
         Add videos to the SQL database
         Args:
             processed_videos: list of processed videos
             connection_str: connection string to the SQL database
+            batch_size: number of rows sent to the database per round trip
         """
 
         # check if there are any videos to process
@@ -427,52 +1558,241 @@ class Scrapper:
 
         with pyodbc.connect(connection_str) as cnxn:
             cursor = cnxn.cursor()
+            self._add_videos(cursor, processed_videos, batch_size)
+            cnxn.commit()
+            if self.known_id_index:
+                self.known_id_index.add(
+                    "videos", (video["video_id"] for video in processed_videos)
+                )
+            print("Videos added to database successfully")
 
-            # Get all unique video ids from the SQL database
-            cursor.execute("SELECT id FROM dbo.Videos")
-            unique_video_ids_sql = {row[0] for row in cursor.fetchall()}
+    def _add_videos(self, cursor, processed_videos, batch_size=DEFAULT_BATCH_SIZE):
+        """
+        Add processed videos to the SQL database without committing
+        Args:
+            cursor: pyodbc cursor (the caller commits)
+            processed_videos: list of processed videos
+            batch_size: number of rows sent to the database per round trip
+        Returns:
+            number of rows inserted into dbo.Videos
+        """
 
-            # Determine which video ids need to be added
-            unique_video_ids_to_add = {
-                video["video_id"] for video in processed_videos
-            } - unique_video_ids_sql
+        # Get the video ids that are already in the SQL database
+        unique_video_ids = {video["video_id"] for video in processed_videos}
+        unique_video_ids_sql = self._existing_ids(cursor, "dbo.Videos", unique_video_ids)
+
+        # Determine which video ids need to be added
+        unique_video_ids_to_add = unique_video_ids - unique_video_ids_sql
+
+        # Filter videos to add
+        videos_to_add = [
+            video for video in processed_videos if video["video_id"] in unique_video_ids_to_add
+        ]
+
+        print("Number of new videos to be added to database", len(videos_to_add))
+
+        timestamp_db = datetime.datetime.fromtimestamp(time.time())  # Current time as datetime
+        rows = [
+            (
+                int(video["video_id"]),
+                video["video_timestamp"],
+                timestamp_db,
+                float(video["video_duration"]),
+                int(video["video_diggcount"]),
+                int(video["video_sharecount"]),
+                int(video["video_commentcount"]),
+                int(video["video_playcount"]),
+                str(video["video_description"]),
+                bool(video["video_is_ad"]),
+                int(video["author_id"]),
+                str(video["suggested_words"]),
+                str(video["url"]),
+                None,
+                None,
+                int(video["sound_id"]) if video["sound_id"] else None,
+                False,
+                None,
+                None,
+                None,
+            )
+            for video in videos_to_add
+        ]
 
-            # Filter videos to add
-            videos_to_add = [
-                video for video in processed_videos if video["video_id"] in unique_video_ids_to_add
-            ]
+        # Add videos to SQL database
+        return self._bulk_insert(cursor, "dbo.Videos", VIDEO_COLUMNS, rows, batch_size)
 
-            print("Number of new videos to be added to database", len(videos_to_add))
-
-            # Add videos to SQL database
-            for video in videos_to_add:
-                query = """
-                INSERT INTO dbo.Videos
-                (id, timestamp_upload, timestamp_db, duration, digg_count, share_count, comment_count, play_count, description, is_ad, author_id, suggested_words, url, transcript_en, transcript_de, sound_id, removed, has_transcript, no_transcript_reason, core_messages_de)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                """
-                data = (
-                    int(video["video_id"]),
-                    video["video_timestamp"],
-                    datetime.datetime.fromtimestamp(time.time()),  # Current time as datetime
-                    float(video["video_duration"]),
-                    int(video["video_diggcount"]),
-                    int(video["video_sharecount"]),
-                    int(video["video_commentcount"]),
-                    int(video["video_playcount"]),
-                    str(video["video_description"]),
-                    bool(video["video_is_ad"]),
-                    int(video["author_id"]),
-                    str(video["suggested_words"]),
-                    str(video["url"]),
-                    None,
-                    None,
-                    int(video["sound_id"]) if video["sound_id"] else None,
-                    False,
-                    None,
-                    None,
-                    None,
-                )
-                cursor.execute(query, data)
+    def ingest_batch(self, processed_videos, connection_str, batch_size=DEFAULT_BATCH_SIZE):
+        """
+        Add the authors, sounds and videos of a crawl batch to the SQL database in dependency
+        order, on one connection and in one transaction: either the whole batch is stored or,
+        if anything fails, nothing is. Connections are reused through pyodbc's ODBC pooling.
+        Args:
+            processed_videos: list of processed videos
+            connection_str: connection string to the SQL database
+            batch_size: number of rows sent to the database per round trip
+        Returns:
+            dict mapping each table to the seconds spent writing it
+        """
+        # check if there are any videos to process
+        if not processed_videos:
+            raise ValueError("No videos to process")
+
+        # check if there is a connection string
+        if not connection_str:
+            raise ValueError("No connection string provided")
+
+        timings = {}
+        cnxn = pyodbc.connect(connection_str, autocommit=False)
+        try:
+            cursor = cnxn.cursor()
+            for table, add_to_db in (
+                ("dbo.Users", self._add_users_from_list_of_videos),
+                ("dbo.Sounds", self._add_sounds),
+                ("dbo.Videos", self._add_videos),
+            ):
+                start = time.perf_counter()
+                add_to_db(cursor, processed_videos, batch_size)
+                timings[table] = time.perf_counter() - start
             cnxn.commit()
-            print("Videos added to database successfully")
+        except Exception:
+            cnxn.rollback()
+            raise
+        finally:
+            cnxn.close()
+        self._remember_ids(processed_videos)
+
+        print(
+            f"Ingested batch of {len(processed_videos)} videos: "
+            + ", ".join(f"{table} {seconds:.2f}s" for table, seconds in timings.items())
+        )
+        return timings
+
+    def replay_archive(
+        self,
+        raw_archive,
+        connection_str,
+        start_date=None,
+        end_date=None,
+        batch_size=DEFAULT_BATCH_SIZE,
+    ):
+        """
+        Re-run process_video and the database ingest on archived raw payloads, without
+        contacting TikTok (e.g. for backfills after a schema change)
+        Args:
+            raw_archive: RawArchive to read from
+            connection_str: connection string to the SQL database
+            start_date: first crawl date (datetime.date) to replay, all if None
+            end_date: last crawl date (datetime.date) to replay, all if None
+            batch_size: number of videos ingested per transaction
+        Returns:
+            number of videos replayed
+        """
+        if not connection_str:
+            raise ValueError("No connection string provided")
+
+        total = 0
+        batch = {}
+        for payload in raw_archive.iter_payloads(start_date, end_date):
+            video = self.process_video(payload)
+            batch[video["video_id"]] = video
+            if len(batch) >= batch_size:
+                self.ingest_batch(list(batch.values()), connection_str, batch_size)
+                total += len(batch)
+                batch = {}
+        if batch:
+            self.ingest_batch(list(batch.values()), connection_str, batch_size)
+            total += len(batch)
+
+        print(f"Replayed {total} videos from {raw_archive.root}")
+        return total
+
+    def _existing_ids(self, cursor, table, ids):
+        """
+        Get the ids of a batch that already exist in a table
+        Only the ids of the batch are sent to the database, in chunks of MAX_QUERY_PARAMETERS,
+        so the cost scales with the batch and not with the size of the table.
+        Args:
+            cursor: pyodbc cursor
+            table: table to look the ids up in, e.g. "dbo.Videos"
+            ids: ids to look up
+        Returns:
+            set of the ids that exist in the table
+        """
+        ids = list(ids)
+        existing_ids = set()
+
+        # Only ask the database about the ids the local index does not know yet
+        kind = INDEX_KINDS.get(table)
+        if self.known_id_index and kind:
+            existing_ids = self.known_id_index.contains(kind, ids)
+            ids = [id_ for id_ in ids if id_ not in existing_ids]
+
+        found_ids = set()
+        for i in range(0, len(ids), MAX_QUERY_PARAMETERS):
+            chunk = ids[i : i + MAX_QUERY_PARAMETERS]
+            placeholders = ", ".join("?" * len(chunk))
+            cursor.execute(f"SELECT id FROM {table} WHERE id IN ({placeholders})", chunk)
+            found_ids.update(row[0] for row in cursor.fetchall())
+
+        if self.known_id_index and kind:
+            self.known_id_index.add(kind, found_ids)
+        return existing_ids | found_ids
+
+    def _bulk_insert(self, cursor, table, columns, rows, batch_size=DEFAULT_BATCH_SIZE):
+        """
+        Insert rows set-based: load them into a temporary staging table in batches of
+        batch_size (one round trip per batch thanks to fast_executemany) and merge the staging
+        table into the target table in a single statement. Rows whose id already exists in the
+        target table, or that repeat an id within rows, are skipped by the MERGE.
+        Args:
+            cursor: pyodbc cursor (the caller commits)
+            table: target table, e.g. "dbo.Videos"
+            columns: column names of the rows, the first one being the id
+            rows: list of tuples in the order of columns
+            batch_size: number of rows sent to the database per round trip
+        Returns:
+            number of rows inserted into the target table
+        """
+        if not rows:
+            return 0
+
+        start = time.perf_counter()
+        staging = f"#staging_{table.split('.')[-1]}"
+        column_list = ", ".join(columns)
+
+        cursor.execute(f"DROP TABLE IF EXISTS {staging}")
+        cursor.execute(f"SELECT TOP 0 {column_list} INTO {staging} FROM {table}")
+
+        cursor.fast_executemany = True
+        insert_query = (
+            f"INSERT INTO {staging} ({column_list}) VALUES ({', '.join('?' * len(columns))})"
+        )
+        for i in range(0, len(rows), batch_size):
+            cursor.executemany(insert_query, rows[i : i + batch_size])
+        cursor.fast_executemany = False
+
+        merge_query = f"""
+        MERGE {table} WITH (HOLDLOCK) AS target
+        USING (
+            SELECT {column_list} FROM (
+                SELECT *,
+                    ROW_NUMBER() OVER (PARTITION BY {columns[0]} ORDER BY (SELECT NULL)) AS rn
+                FROM {staging}
+            ) AS deduplicated
+            WHERE rn = 1
+        ) AS source
+        ON target.{columns[0]} = source.{columns[0]}
+        WHEN NOT MATCHED BY TARGET THEN
+            INSERT ({column_list})
+            VALUES ({", ".join(f"source.{column}" for column in columns)});
+        """
+        cursor.execute(merge_query)
+        inserted = cursor.rowcount
+        cursor.execute(f"DROP TABLE {staging}")
+
+        elapsed = time.perf_counter() - start
+        print(
+            f"Inserted {inserted} of {len(rows)} rows into {table} in {elapsed:.2f}s "
+            f"({len(rows) / elapsed:.0f} rows/s)"
+        )
+        return inserted
@@ -0,0 +1,112 @@
+import hashlib
+import math
+
+
+class SeenIds:
+    """Exact set of the video ids seen during a crawl"""
+
+    def __init__(self):
+        self.ids = set()
+
+    def add(self, id_):
+        """
+        Add an id
+        Args:
+            id_: video id
+        Returns:
+            True if the id was not seen before
+        """
+        id_ = int(id_)
+        if id_ in self.ids:
+            return False
+        self.ids.add(id_)
+        return True
+
+    def __contains__(self, id_):
+        return int(id_) in self.ids
+
+    def discard(self, id_):
+        """
+        Forget an id, e.g. of a video that was not processed after all
+        Args:
+            id_: video id
+        """
+        self.ids.discard(int(id_))
+
+    def clear(self):
+        """Forget all ids"""
+        self.ids = set()
+
+
+class BloomFilter:
+    """
+    Bloom filter of the video ids seen during a crawl, bounded to a fixed memory budget
+
+    Unlike SeenIds it never grows, at the price of false positives: with n ids added to a
+    filter of m bits and k hash functions, a new id is wrongly reported as seen with a
+    probability of about (1 - e^(-k * n / m))^k (1% for 1M ids in 1.2 MB).
+    """
+
+    def __init__(self, memory_bytes=1024 * 1024, expected_items=1_000_000):
+        """
+        Initialize the bloom filter
+        Args:
+            memory_bytes: size of the bit array in bytes
+            expected_items: number of ids the filter is sized for
+        """
+        self.num_bits = memory_bytes * 8
+        self.num_hashes = max(1, round(self.num_bits / expected_items * math.log(2)))
+        self.bits = bytearray(memory_bytes)
+
+    def _positions(self, id_):
+        digest = hashlib.blake2b(str(int(id_)).encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def add(self, id_):
+        """
+        Add an id
+        Args:
+            id_: video id
+        Returns:
+            True if the id was (most likely) not seen before
+        """
+        is_new = False
+        for position in self._positions(id_):
+            byte, bit = divmod(position, 8)
+            if not self.bits[byte] & (1 << bit):
+                self.bits[byte] |= 1 << bit
+                is_new = True
+        return is_new
+
+    def __contains__(self, id_):
+        return all(
+            self.bits[position // 8] & (1 << position % 8) for position in self._positions(id_)
+        )
+
+    def discard(self, id_):
+        """
+        Does nothing: the bits of an id are shared with other ids, so it stays reported as seen
+        until clear()
+        Args:
+            id_: video id
+        """
+
+    def clear(self):
+        """Forget all ids"""
+        self.bits = bytearray(len(self.bits))
+
+
+def make_seen_filter(memory_budget_bytes=None, expected_items=1_000_000):
+    """
+    Create the structure used to drop duplicate videos during a crawl
+    Args:
+        memory_budget_bytes: None for an exact set, otherwise the size of a bloom filter
+        expected_items: number of ids the bloom filter is sized for
+    Returns:
+        SeenIds or BloomFilter
+    """
+    if memory_budget_bytes is None:
+        return SeenIds()
+    return BloomFilter(memory_budget_bytes, expected_items)
@@ -0,0 +1,131 @@
+import asyncio
+import time
+
+from TikTokApi import TikTokApi
+
+
+class SessionPool:
+    """
+    Keeps one TikTokApi instance with its browser sessions alive across scraper calls
+
+    The browser is launched on the first acquire and reused afterwards, as long as the sessions
+    are healthy, not older than max_session_age and were created with the requested ms_tokens.
+    Otherwise the sessions are recycled: closed and created again. Every acquire is a lease
+    that has to be given back with release(): sessions are only recycled once no caller holds
+    them, an acquire that needs new sessions waits until then.
+    """
+
+    def __init__(
+        self, headless=False, sleep_after=3, max_session_age=30 * 60, api_factory=TikTokApi
+    ):
+        """
+        Initialize the session pool
+        Args:
+            headless: run the browser without a window (for servers)
+            sleep_after: seconds to wait after creating the sessions
+            max_session_age: seconds after which the sessions are recycled, so expired
+                ms_tokens get refreshed
+            api_factory: callable returning a TikTokApi instance
+        """
+        self.headless = headless
+        self.sleep_after = sleep_after
+        self.max_session_age = max_session_age
+        self.api_factory = api_factory
+
+        self.api = None
+        self.ms_tokens = None
+        self.num_sessions = 0
+        self.started_at = None
+        self.healthy = False
+        self.leases = 0
+        self._released = asyncio.Condition()
+
+    async def acquire(self, ms_tokens, num_sessions=1):
+        """
+        Get a TikTokApi instance with at least num_sessions sessions for the given tokens
+        The caller has to release() it once done.
+        Args:
+            ms_tokens: pool of ms_tokens the sessions have to be created with
+            num_sessions: minimal number of sessions
+        Returns:
+            TikTokApi instance with created sessions
+        """
+        async with self._released:
+            while True:
+                reusable = (
+                    self.api is not None
+                    and self.ms_tokens == list(ms_tokens)
+                    and self.num_sessions >= num_sessions
+                    and time.monotonic() - self.started_at < self.max_session_age
+                )
+                if reusable and await self.is_healthy():
+                    self.leases += 1
+                    return self.api
+                if not self.leases:
+                    break
+                # other callers still use the sessions: recycle them once they are released
+                await self._released.wait()
+
+            await self._close()
+            print(f"Starting {num_sessions} TikTok session(s)")
+            api = self.api_factory()
+            await api.create_sessions(
+                ms_tokens=list(ms_tokens),
+                num_sessions=num_sessions,
+                sleep_after=self.sleep_after,
+                headless=self.headless,
+            )
+            self.api = api
+            self.ms_tokens = list(ms_tokens)
+            self.num_sessions = num_sessions
+            self.started_at = time.monotonic()
+            self.healthy = True
+            self.leases += 1
+            return self.api
+
+    async def release(self):
+        """Give back the TikTokApi instance of an acquire, so the sessions can be recycled"""
+        async with self._released:
+            self.leases -= 1
+            self._released.notify_all()
+
+    async def is_healthy(self, timeout=5):
+        """
+        Check that all sessions are still usable
+        Args:
+            timeout: seconds a session's page may take to respond
+        Returns:
+            True if no failure was reported and every session's page responds
+        """
+        if self.api is None or not self.healthy:
+            return False
+        sessions = getattr(self.api, "sessions", [])
+        if len(sessions) < self.num_sessions:
+            return False
+        try:
+            for session in sessions:
+                if session.page.is_closed():
+                    return False
+                await asyncio.wait_for(session.page.evaluate("1"), timeout=timeout)
+        except Exception:
+            return False
+        return True
+
+    def mark_unhealthy(self):
+        """Report a failed session, so the sessions get recycled on the next acquire"""
+        self.healthy = False
+
+    async def close(self):
+        """Close the sessions and the browser"""
+        async with self._released:
+            await self._close()
+
+    async def _close(self):
+        if self.api is None:
+            return
+        api, self.api = self.api, None
+        try:
+            await api.close_sessions()
+            await api.stop_playwright()
+        except Exception as e:
+            print(f"Closing the TikTok sessions failed: {e}")
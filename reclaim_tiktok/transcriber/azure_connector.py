@@ -1,13 +1,17 @@
+import functools
 import logging
 import os
+import threading
 import time
+from collections.abc import Iterable
+from concurrent.futures import Future, ThreadPoolExecutor
 
 import azure.cognitiveservices.speech as speechsdk
-import browser_cookie3
 import requests
 from azure.storage.blob import BlobServiceClient
 from dotenv import load_dotenv
 
+from reclaim_tiktok.transcriber.http_client import HTTP_CLIENT
 from reclaim_tiktok.video_indexer.consts import Consts
 from reclaim_tiktok.video_indexer.video_indexer_client import VideoIndexerClient
 
@@ -23,18 +27,48 @@ ACCOUNT_ID = os.environ["RECLAIM_TIKTOK_ACCOUNT_ID"]
 VIDEO_ACCESS_TOKEN = os.environ["AZURE_VIDEO_ACCESS_TOKEN"]
 STORAGE_CONNECTION_STR = os.environ["AZURE_STORAGE_CONNECTION_STR"]
 
-
-class AzureConnector:
-    """Provides functionality for connecting to the Azure Endpoints"""
-
-    """Function taken and slightly modified from https://github.com/Azure-Samples/cognitive-services-speech-sdk/blob/b55026a09e2f807db9289acd6cdd3b623f44b3e9/samples/python/console/translation_sample.py#L231"""
-
-    def translation_continuous_with_lid_from_multilingual_file(
-        filename: str, speech_key: str = None, service_region: str = None
-    ) -> dict:
-        """performs continuous speech translation from a multi-lingual
-        audio file, with continuous language identification
+# Audio format pushed to the Speech SDK: mono 16 bit PCM at this many samples per second
+PCM_SAMPLE_RATE = 16000
+# Speech translations running at the same time, per Speech resource
+DEFAULT_MAX_CONCURRENT_RECOGNITIONS = 4
+# Seconds after which a speech translation is stopped
+DEFAULT_RECOGNITION_TIMEOUT = 600
+
+
+class SpeechRecognitionService:
+    """Runs Azure speech translations with continuous language
+    identification, a bounded number of them at the same time
+
+    The translation config is built once and shared by all recognitions.
+    Every recognition waits for its session to stop on an event instead of
+    polling, and is stopped if it takes longer than its timeout. Jobs are
+    submitted to a thread pool and return futures, so callers can
+    transcribe several videos at once:
+
+        service = SpeechRecognitionService(max_concurrency=8)
+        futures = [service.submit_file(name) for name in filenames]
+        transcripts = [future.result() for future in futures]
+    """
+
+    """Recognition taken and slightly modified from https://github.com/Azure-Samples/cognitive-services-speech-sdk/blob/b55026a09e2f807db9289acd6cdd3b623f44b3e9/samples/python/console/translation_sample.py#L231"""
+
+    def __init__(
+        self,
+        speech_key: str = None,
+        service_region: str = None,
+        max_concurrency: int = DEFAULT_MAX_CONCURRENT_RECOGNITIONS,
+        timeout: float = DEFAULT_RECOGNITION_TIMEOUT,
+    ) -> None:
+        """
+        Params
+        ---
+        :param speech_key: key of the Azure Speech resource
+        :param service_region: region of the Azure Speech resource
+        :param max_concurrency: number of recognitions running at once,
+            at most the concurrent requests of the Speech resource
+        :param timeout: seconds after which a recognition is stopped
         """
+        self.timeout = timeout
 
         # <TranslationContinuousWithLID>
 
@@ -47,31 +81,105 @@ class AzureConnector:
         endpoint_string = "wss://{}.stt.speech.microsoft.com/speech/universal/v2".format(
             service_region or REGION
         )
-        translation_config = speechsdk.translation.SpeechTranslationConfig(
+        self.translation_config = speechsdk.translation.SpeechTranslationConfig(
             subscription=speech_key or SPEECH_SUBSCRIPTION_KEY,
             endpoint=endpoint_string,
             target_languages=("de", "en"),
         )
-        audio_config = speechsdk.audio.AudioConfig(filename=filename)
 
         # Since the spoken language in the input audio changes,
         # you need to set the language identification to "Continuous" mode.
         # (override the default value of "AtStart").
-        translation_config.set_property(
+        self.translation_config.set_property(
             property_id=speechsdk.PropertyId.SpeechServiceConnection_LanguageIdMode,
             value="Continuous",
         )
 
         # Specify the AutoDetectSourceLanguageConfig, which defines the number of possible languages
-        auto_detect_source_language_config = (
+        self.auto_detect_source_language_config = (
             speechsdk.languageconfig.AutoDetectSourceLanguageConfig(languages=["en-US", "de-DE"])
         )
 
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_concurrency, thread_name_prefix="speech"
+        )
+
+    def submit_file(self, filename: str, timeout: float = None) -> Future:
+        """Starts the translation of an audio file
+
+        Params
+        ---
+        :param filename: path to a wav file
+        :param timeout: seconds after which the recognition is stopped,
+            defaults to the timeout of the service
+
+        Returns
+        ---
+        :returns: Future of a dictionary with possible keys 'eng-US',
+            'deu-DE', or empty
+        """
+        audio_config = speechsdk.audio.AudioConfig(filename=filename)
+        return self._executor.submit(self.recognize, audio_config, None, timeout)
+
+    def submit_pcm_stream(
+        self, pcm_chunks: Iterable[bytes], sample_rate: int = PCM_SAMPLE_RATE, timeout=None
+    ) -> Future:
+        """Starts the translation of raw audio, which is pushed to the
+        Speech SDK chunk by chunk while the recognition is running
+
+        Params
+        ---
+        :param pcm_chunks: iterable of bytes of mono 16 bit little endian
+            PCM audio, consumed by the recognition thread
+        :param sample_rate: samples per second of the audio
+        :param timeout: seconds after which the recognition is stopped,
+            defaults to the timeout of the service
+
+        Returns
+        ---
+        :returns: Future of a dictionary with possible keys 'eng-US',
+            'deu-DE', or empty
+        """
+        stream_format = speechsdk.audio.AudioStreamFormat(
+            samples_per_second=sample_rate, bits_per_sample=16, channels=1
+        )
+        push_stream = speechsdk.audio.PushAudioInputStream(stream_format=stream_format)
+
+        def feed():
+            try:
+                for chunk in pcm_chunks:
+                    push_stream.write(chunk)
+            finally:
+                # signals the end of the audio to the recognizer
+                push_stream.close()
+
+        audio_config = speechsdk.audio.AudioConfig(stream=push_stream)
+        return self._executor.submit(self.recognize, audio_config, feed, timeout)
+
+    def recognize(self, audio_config, feed=None, timeout: float = None) -> dict:
+        """Translates the audio of ``audio_config`` in the calling thread
+
+        Params
+        ---
+        :param audio_config: speechsdk.audio.AudioConfig of the audio
+        :param feed: called once the recognition started, to push the
+            audio of a stream
+        :param timeout: seconds after which the recognition is stopped,
+            defaults to the timeout of the service
+
+        Returns
+        ---
+        :returns: dictionary containing possible keys 'eng-US',
+            'deu-DE', or empty
+        """
+        timeout = timeout or self.timeout
+        started_at = time.monotonic()
+
         # Creates a translation recognizer using and audio file as input.
         recognizer = speechsdk.translation.TranslationRecognizer(
-            translation_config=translation_config,
+            translation_config=self.translation_config,
             audio_config=audio_config,
-            auto_detect_source_language_config=auto_detect_source_language_config,
+            auto_detect_source_language_config=self.auto_detect_source_language_config,
         )
 
         translations = {}
@@ -82,8 +190,6 @@ class AzureConnector:
                 # src_lang = evt.result.properties[speechsdk.PropertyId.SpeechServiceConnection_AutoDetectSourceLanguageResult]
                 LOG.info("Succesful translation and transcription from Azure")
 
-                nonlocal translations
-
                 # Add a space between each streamed caption and the
                 # previous translations
                 translations["eng-US"] = (
@@ -93,33 +199,30 @@ class AzureConnector:
                     translations.get("deu-DE", "") + evt.result.translations["de"] + " "
                 )
             elif evt.result.reason == speechsdk.ResultReason.RecognizedSpeech:
-                print("Recognized:\n {}".format(evt.result.text))
+                LOG.debug("Recognized: %s", evt.result.text)
             elif evt.result.reason == speechsdk.ResultReason.NoMatch:
-                print("No speech could be recognized: {}".format(evt.result.no_match_details))
+                LOG.debug("No speech could be recognized: %s", evt.result.no_match_details)
             elif evt.result.reason == speechsdk.ResultReason.Canceled:
-                print("Translation canceled: {}".format(evt.result.cancellation_details.reason))
+                LOG.warning("Translation canceled: %s", evt.result.cancellation_details.reason)
                 if evt.result.cancellation_details.reason == speechsdk.CancellationReason.Error:
-                    print(
-                        "Error details: {}".format(evt.result.cancellation_details.error_details)
-                    )
+                    LOG.warning("Error details: %s", evt.result.cancellation_details.error_details)
 
-        done = False
+        done = threading.Event()
 
         def stop_cb(evt):
             """callback that signals to stop continuous recognition upon receiving an event `evt`"""
-            print("CLOSING on {}".format(evt))
-            nonlocal done
-            done = True
+            LOG.debug("CLOSING on %s", evt)
+            done.set()
 
         # connect callback functions to the events fired by the recognizer
-        recognizer.session_started.connect(lambda evt: print("SESSION STARTED: {}".format(evt)))
-        recognizer.session_stopped.connect(lambda evt: print("SESSION STOPPED {}".format(evt)))
+        recognizer.session_started.connect(lambda evt: LOG.debug("SESSION STARTED: %s", evt))
+        recognizer.session_stopped.connect(lambda evt: LOG.debug("SESSION STOPPED %s", evt))
 
         # event for final result
-        recognizer.recognized.connect(lambda evt: result_callback(evt))
+        recognizer.recognized.connect(result_callback)
 
         # cancellation event
-        recognizer.canceled.connect(lambda evt: print("CANCELED: {} ({})".format(evt, evt.reason)))
+        recognizer.canceled.connect(lambda evt: LOG.debug("CANCELED: %s (%s)", evt, evt.reason))
 
         # stop continuous recognition on either session stopped or canceled events
         recognizer.session_stopped.connect(stop_cb)
@@ -128,13 +231,78 @@ class AzureConnector:
         # start translation
         recognizer.start_continuous_recognition()
 
-        while not done:
-            time.sleep(0.5)
+        try:
+            if feed is not None:
+                feed()
 
-        recognizer.stop_continuous_recognition()
+            remaining = timeout - (time.monotonic() - started_at)
+            if not done.wait(max(0.0, remaining)):
+                raise TimeoutError(f"Speech recognition did not finish within {timeout}s")
+        finally:
+            recognizer.stop_continuous_recognition()
 
         return translations
 
+    def close(self) -> None:
+        """Waits for the running recognitions and shuts the thread pool down"""
+        self._executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+@functools.lru_cache
+def get_speech_service(
+    speech_key: str = None, service_region: str = None
+) -> SpeechRecognitionService:
+    """Gets the process-wide SpeechRecognitionService of a Speech resource
+
+    Params
+    ---
+    :param speech_key: key of the Azure Speech resource, from the
+        environment if None
+    :param service_region: region of the Azure Speech resource, from the
+        environment if None
+    """
+    return SpeechRecognitionService(speech_key, service_region)
+
+
+class AzureConnector:
+    """Provides functionality for connecting to the Azure Endpoints"""
+
+    def translation_continuous_with_lid_from_multilingual_file(
+        filename: str, speech_key: str = None, service_region: str = None
+    ) -> dict:
+        """performs continuous speech translation from a multi-lingual
+        audio file, with continuous language identification
+        """
+        service = get_speech_service(speech_key, service_region)
+        return service.submit_file(filename).result()
+
+    def translation_continuous_with_lid_from_pcm_stream(
+        pcm_chunks: Iterable[bytes],
+        speech_key: str = None,
+        service_region: str = None,
+        sample_rate: int = PCM_SAMPLE_RATE,
+    ) -> dict:
+        """performs continuous speech translation from raw audio, with
+        continuous language identification, without touching the disk
+
+        The chunks are pushed to the Speech SDK while the recognition is
+        already running, so it starts before the audio is fully decoded.
+
+        Params
+        ---
+        :param pcm_chunks: iterable of bytes of mono 16 bit little endian
+            PCM audio
+        :param sample_rate: samples per second of the audio
+        """
+        service = get_speech_service(speech_key, service_region)
+        return service.submit_pcm_stream(pcm_chunks, sample_rate).result()
+
     def copied_get_ocr_from_azure(
         url: str, video_name: str, video_description: str = None, excluded_ai: list = None
     ) -> dict:
@@ -219,8 +387,6 @@ class AzureConnector:
         return {}
 
     def upload_file_to_storage(url: str, blob_name: str, cookies=None) -> None:
-        if cookies is None:
-            cookies = getattr(browser_cookie3, "chrome")(domain_name="www.tiktok.com")
         headers = {
             "Accept-Encoding": "gzip, deflate, sdch",
             "Accept-Language": "en-US,en;q=0.8",
@@ -231,7 +397,10 @@ class AzureConnector:
             "Connection": "keep-alive",
             "referer": "https://www.tiktok.com/",
         }
-        result = requests.get(url, headers=headers, cookies=cookies)
+        # without explicit cookies, the browser cookies of the shared client are sent
+        result = HTTP_CLIENT.get(
+            url, with_cookies=cookies is None, headers=headers, cookies=cookies
+        )
         if result.status_code != 200:
             print("Request Unsuccessful:")
             print(result.reason)
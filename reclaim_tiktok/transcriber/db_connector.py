@@ -1,11 +1,21 @@
+import contextlib
+import functools
+import itertools
 import logging
 import os
+import time
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 
 import pyodbc
 from dotenv import load_dotenv
 
+from reclaim_tiktok.transcriber.disk_cache import DISK_CACHE
 from reclaim_tiktok.transcriber.main_transcriber import StatCollector, print_progress_bar
+from reclaim_tiktok.transcriber.sound_cache import SOUND_TRANSCRIPTS
 from reclaim_tiktok.transcriber.tiktok_video_details import (
+    DEFAULT_REQUESTS_PER_SECOND_PER_HOST,
+    HOST_RATE_LIMITER,
     HTTPRequestError,
     RequestReturnedNoneError,
     TiktokVideoDetails,
@@ -16,6 +26,56 @@ load_dotenv()
 
 LOG = logging.getLogger("reclaim_tiktok")
 
+# Transcripts are written and committed every DEFAULT_FLUSH_EVERY videos
+# or DEFAULT_FLUSH_INTERVAL seconds, whichever comes first
+DEFAULT_FLUSH_EVERY = 100
+DEFAULT_FLUSH_INTERVAL = 30.0
+# SQL Server accepts at most 2100 parameters per statement, 5 per updated video
+MAX_UPDATE_ROWS = 400
+
+# Rows fetched per query by the iter_videos_* readers
+DEFAULT_PAGE_SIZE = 1000
+VIDEO_COLUMNS = (
+    "id",
+    "timestamp_upload",
+    "timestamp_db",
+    "duration",
+    "digg_count",
+    "share_count",
+    "comment_count",
+    "play_count",
+    "description",
+    "is_ad",
+    "author_id",
+    "suggested_words",
+    "url",
+    "transcript_en",
+    "transcript_de",
+    "sound_id",
+    "removed",
+    "has_transcript",
+    "no_transcript_reason",
+    "core_messages_de",
+)
+
+WITHOUT_TRANSCRIPTION = (
+    "transcript_en IS NULL AND transcript_de IS NULL AND no_transcript_reason IS NULL"
+)
+WITH_TRANSCRIPTION = "transcript_en IS NOT NULL OR transcript_de IS NOT NULL"
+WITH_GERMAN_TRANSCRIPTION = "transcript_de IS NOT NULL"
+WITH_GERMAN_TRANSCRIPTION_WITHOUT_CORE_MESSAGE = (
+    "transcript_de IS NOT NULL AND core_messages_de IS NULL"
+)
+WITH_GERMAN_TRANSCRIPTION_WITH_CORE_MESSAGE = (
+    "transcript_de IS NOT NULL AND core_messages_de IS NOT NULL"
+)
+
+
+@functools.lru_cache
+def _video_record(columns: tuple) -> type:
+    """Named tuple type of the records yielded by DBConnector.iter_videos"""
+    return namedtuple("VideoRecord", columns)
+
 
 class DBConnector:
     def __init__(self):
@@ -41,10 +101,7 @@ class DBConnector:
         """
         with pyodbc.connect(self.connection_str) as cnxn:
             cursor = cnxn.cursor()
-            query = (
-                f"SELECT * FROM {self.table} "
-                "WHERE transcript_en IS NULL AND transcript_de IS NULL AND no_transcript_reason IS NULL"
-            )
+            query = f"SELECT * FROM {self.table} WHERE {WITHOUT_TRANSCRIPTION} ORDER BY id"
             cursor.execute(query)
             rows = cursor.fetchall()
             LOG.debug("Fetched %d rows without transcription", len(rows))
@@ -58,10 +115,7 @@ class DBConnector:
         """
         with pyodbc.connect(self.connection_str) as cnxn:
             cursor = cnxn.cursor()
-            query = (
-                f"SELECT * FROM {self.table} "
-                "WHERE transcript_en IS NOT NULL OR transcript_de IS NOT NULL"
-            )
+            query = f"SELECT * FROM {self.table} WHERE {WITH_TRANSCRIPTION}"
             cursor.execute(query)
             rows = cursor.fetchall()
             return rows
@@ -74,7 +128,7 @@ class DBConnector:
         """
         with pyodbc.connect(self.connection_str) as cnxn:
             cursor = cnxn.cursor()
-            query = f"SELECT * FROM {self.table} " "WHERE transcript_de IS NOT NULL"
+            query = f"SELECT * FROM {self.table} WHERE {WITH_GERMAN_TRANSCRIPTION}"
             cursor.execute(query)
             rows = cursor.fetchall()
             return rows
@@ -89,7 +143,7 @@ class DBConnector:
             cursor = cnxn.cursor()
             query = (
                 f"SELECT * FROM {self.table} "
-                "WHERE transcript_de IS NOT NULL AND core_messages_de IS NULL"
+                f"WHERE {WITH_GERMAN_TRANSCRIPTION_WITHOUT_CORE_MESSAGE}"
             )
             cursor.execute(query)
             rows = cursor.fetchall()
@@ -105,12 +159,121 @@ class DBConnector:
             cursor = cnxn.cursor()
             query = (
                 f"SELECT * FROM {self.table} "
-                "WHERE transcript_de IS NOT NULL AND core_messages_de IS NOT NULL"
+                f"WHERE {WITH_GERMAN_TRANSCRIPTION_WITH_CORE_MESSAGE}"
             )
             cursor.execute(query)
             rows = cursor.fetchall()
             return rows
 
+    def iter_videos(
+        self,
+        where: str = None,
+        columns: tuple = ("id", "url"),
+        page_size: int = DEFAULT_PAGE_SIZE,
+        start_after_id: int = None,
+    ):
+        """
+        Stream videos from the database, page by page in the order of their id
+        Every page is a separate query continuing after the last id of the previous one
+        (keyset pagination), so memory stays constant, the first rows arrive right away and
+        rows updated while iterating are neither skipped nor repeated.
+        Args:
+            where (str): SQL condition the videos have to meet, all videos if None
+            columns (tuple): Columns to select, "id" is always included
+            page_size (int): Number of rows fetched per query
+            start_after_id (int): Only yield videos with a greater id, e.g. to resume
+        Yields:
+            VideoRecord: named tuple with the selected columns, e.g. record.id, record.url
+        """
+        unknown_columns = set(columns) - set(VIDEO_COLUMNS)
+        if unknown_columns:
+            raise ValueError(f"Unknown columns {sorted(unknown_columns)}")
+        if "id" not in columns:
+            columns = ("id", *columns)
+        columns = tuple(columns)
+        record = _video_record(columns)
+
+        conditions = [f"({where})"] if where else []
+        conditions.append("id > ?")
+        query = (
+            f"SELECT TOP ({int(page_size)}) {', '.join(columns)} FROM {self.table} "
+            f"WHERE {' AND '.join(conditions)} ORDER BY id"
+        )
+        id_index = columns.index("id")
+        last_id = start_after_id if start_after_id is not None else -(2**63)
+
+        with pyodbc.connect(self.connection_str) as cnxn:
+            cursor = cnxn.cursor()
+            while True:
+                cursor.execute(query, last_id)
+                rows = cursor.fetchall()
+                LOG.debug("Fetched page of %d rows after id %d", len(rows), last_id)
+                for row in rows:
+                    yield record(*row)
+                if len(rows) < page_size:
+                    return
+                last_id = rows[-1][id_index]
+
+    def count_videos(self, where: str = None) -> int:
+        """
+        Count the videos in the database
+        Args:
+            where (str): SQL condition the videos have to meet, all videos if None
+        Returns:
+            int: The number of videos
+        """
+        with pyodbc.connect(self.connection_str) as cnxn:
+            cursor = cnxn.cursor()
+            query = f"SELECT COUNT(*) FROM {self.table}"
+            if where:
+                query += f" WHERE {where}"
+            cursor.execute(query)
+            return cursor.fetchone()[0]
+
+    def iter_videos_without_transcription(self, columns=("id", "url"), **kwargs):
+        """
+        Stream the videos that do not have a transcript, see iter_videos
+        Yields:
+            VideoRecord: The rows that do not have a transcript
+        """
+        return self.iter_videos(WITHOUT_TRANSCRIPTION, columns, **kwargs)
+
+    def iter_videos_with_transcription(self, columns=("id", "url"), **kwargs):
+        """
+        Stream the videos that have a transcript, see iter_videos
+        Yields:
+            VideoRecord: The rows that have a transcript
+        """
+        return self.iter_videos(WITH_TRANSCRIPTION, columns, **kwargs)
+
+    def iter_videos_with_german_transcription(self, columns=("id", "url"), **kwargs):
+        """
+        Stream the videos that have a german transcript, see iter_videos
+        Yields:
+            VideoRecord: The rows that have a german transcript
+        """
+        return self.iter_videos(WITH_GERMAN_TRANSCRIPTION, columns, **kwargs)
+
+    def iter_videos_with_german_transcription_without_core_message(
+        self, columns=("id", "url"), **kwargs
+    ):
+        """
+        Stream the videos that have a german transcript but no core message, see iter_videos
+        Yields:
+            VideoRecord: The rows that have a german transcript but no core message
+        """
+        return self.iter_videos(WITH_GERMAN_TRANSCRIPTION_WITHOUT_CORE_MESSAGE, columns, **kwargs)
+
+    def iter_videos_with_german_transcription_with_core_message(
+        self, columns=("id", "url"), **kwargs
+    ):
+        """
+        Stream the videos that have a german transcript and a core message, see iter_videos
+        Yields:
+            VideoRecord: The rows that have a german transcript and a core message
+        """
+        return self.iter_videos(WITH_GERMAN_TRANSCRIPTION_WITH_CORE_MESSAGE, columns, **kwargs)
+
     def update_transcript(
         self,
         video_id: int,
@@ -146,90 +309,99 @@ class DBConnector:
                 query, transcript_en, transcript_de, has_transcript, no_transcript_reason, video_id
             )
 
-    def update_transcript_multiple(self, rows: list[pyodbc.Row]) -> None:
+    def update_transcript_multiple(
+        self,
+        rows,
+        workers: int = 1,
+        requests_per_second_per_host: float = None,
+        flush_every: int = DEFAULT_FLUSH_EVERY,
+        flush_interval: float = DEFAULT_FLUSH_INTERVAL,
+        total_rows: int = None,
+        disable_azure: bool = True,
+    ) -> None:
         """
         Update the transcripts of multiple videos in the database
+        With several workers, the videos are fetched and transcribed in a thread pool while
+        the results are written to the database by the calling thread only.
+        Results are buffered and written as one multi-row UPDATE, committed right away,
+        every flush_every videos or flush_interval seconds and when the run stops, so a crash
+        loses at most one buffer. Committed videos have a transcript or a
+        no_transcript_reason, so they drop out of get_videos_without_transcription and a new
+        run resumes where the last one stopped.
 
         Args:
-            rows (list[pyodbc.Row]): List of rows to be updated
+            rows (Iterable): Rows to be updated with (at least) an id and a url column, e.g.
+                a list of pyodbc.Row or iter_videos_without_transcription()
+            workers (int): Number of videos fetched and transcribed at the same time
+            requests_per_second_per_host (float): Limit of the requests per second to one
+                host (Tiktok, subtitle CDN) by all workers together during this call, defaults
+                to DEFAULT_REQUESTS_PER_SECOND_PER_HOST with several workers and to no limit
+                with one
+            flush_every (int): Number of buffered videos after which they are written
+            flush_interval (float): Seconds after which buffered videos are written
+            total_rows (int): Number of rows for the progress bar, defaults to len(rows)
+            disable_azure (bool): Do not fall back to Azure Speech to Text for videos without
+                Tiktok subtitles; if enabled, transcripts of non-original sounds are reused
+                from other videos with the same sound
         """
-        with pyodbc.connect(self.connection_str) as cnxn:
+        if workers < 1:
+            raise ValueError("workers must be at least 1")
+        if requests_per_second_per_host is None and workers > 1:
+            requests_per_second_per_host = DEFAULT_REQUESTS_PER_SECOND_PER_HOST
+        rate_limit = (
+            HOST_RATE_LIMITER.limit(requests_per_second_per_host)
+            if requests_per_second_per_host is not None
+            else contextlib.nullcontext()
+        )
+        if not disable_azure and SOUND_TRANSCRIPTS.lookup is None:
+            SOUND_TRANSCRIPTS.lookup = self.get_sound_transcript
+
+        with rate_limit, pyodbc.connect(self.connection_str) as cnxn:
             cursor = cnxn.cursor()
-            query = f"""
-            UPDATE {self.table}
-            SET transcript_en = ?, transcript_de = ?, has_transcript = ?, no_transcript_reason = ?
-            WHERE id = ?
-            """
 
-            total_rows = len(rows)
+            if total_rows is None and hasattr(rows, "__len__"):
+                total_rows = len(rows)
             stats = StatCollector()
+            video_id = None
+            updates = []
+            last_flush = time.monotonic()
 
-            def update_with_failure(failure_reason: str, video_id: int):
-                cursor.execute(query, None, None, False, failure_reason, video_id)
+            def flush():
+                nonlocal last_flush
+                if updates:
+                    self._update_transcripts(cursor, updates)
+                    cnxn.commit()
+                    LOG.debug("Committed %d transcript updates", len(updates))
+                    updates.clear()
+                last_flush = time.monotonic()
 
             try:
                 index = 0
-                for row in rows:
-                    completion_percentage = (index / total_rows) * 100
+                print_progress_bar(0, done=0, successes=0, private=0, failed=0)
+                transcribed = _transcribe_rows(rows, workers, disable_azure)
+                for video_id, url, outcome, values in transcribed:
+                    index += 1
+                    if outcome == "success":
+                        stats.add_success()
+                    elif outcome == "private":
+                        stats.add_private_video(url)
+                    elif outcome == "failed":
+                        stats.add_failed_request(url)
+                    updates.append((video_id, *values))
+                    if (
+                        len(updates) >= flush_every
+                        or time.monotonic() - last_flush >= flush_interval
+                    ):
+                        flush()
+
+                    completion_percentage = (index / total_rows) * 100 if total_rows else 0
                     print_progress_bar(
                         completion_percentage,
+                        done=index,
                         successes=stats.successes,
                         private=len(stats.private_videos),
                         failed=len(stats.failed_requests),
                     )
-                    video_id = row[0]
-                    url = row[12]
-                    index += 1
-                    try:
-                        tt_obj = TiktokVideoDetails(url=url)
-                    except VideoIsPrivateError as error:
-                        stats.add_private_video(url)
-                        update_with_failure(str(error), video_id)
-                        LOG.info("Video is private", extra={"video_id": video_id})
-                        continue
-                    except (RequestReturnedNoneError, HTTPRequestError) as error:
-                        stats.add_failed_request(url)
-                        update_with_failure(str(error), video_id)
-                        LOG.info("Video request returned None", extra={"video_id": video_id})
-                        continue
-                    except Exception as error:
-                        stats.add_failed_request(url)
-                        LOG.exception(
-                            "\nUnexpected Exception occured: %s",
-                            error,
-                            extra={"video_id": video_id},
-                        )
-                        update_with_failure(str(error), video_id)
-                        continue
-
-                    try:
-                        transcriptions = tt_obj.get_transcriptions(disable_azure=True)
-                        if transcriptions:
-                            cursor.execute(
-                                query,
-                                transcriptions.get("eng-US", None),
-                                transcriptions.get("deu-DE", None),
-                                True,
-                                None,
-                                video_id,
-                            )
-                            stats.add_success()
-                            LOG.debug(
-                                "Video transcripts added succesfully", extra={"video_id": video_id}
-                            )
-                        else:
-                            update_with_failure("No transcription provided by Tiktok", video_id)
-                            LOG.debug("Video has no transcription", extra={"video_id": video_id})
-
-                    except Exception as error:
-                        # print("\n", error)
-                        LOG.exception(
-                            "Unexpected error when getting transcripts: %s",
-                            error,
-                            extra={"video_id": video_id},
-                        )
-                        update_with_failure(str(error), video_id)
-                        # ? stats.add_failed_request(url)
 
             except KeyboardInterrupt:
                 print("\nKeyboard Interrupt detected. Stopping...")
@@ -241,7 +413,65 @@ class DBConnector:
                     extra={"video_id": video_id},
                 )
             finally:
+                try:
+                    flush()
+                except Exception as error:
+                    LOG.exception(
+                        "Writing the last %d transcripts failed: %s", len(updates), error
+                    )
                 stats.print_stats()
+                SOUND_TRANSCRIPTS.print_stats()
+                DISK_CACHE.print_stats()
+
+    def _update_transcripts(self, cursor: pyodbc.Cursor, updates: list[tuple]) -> None:
+        """
+        Update the transcripts of several videos with one statement per MAX_UPDATE_ROWS videos,
+        without committing
+        Args:
+            cursor (pyodbc.Cursor): Cursor of the connection (the caller commits)
+            updates (list[tuple]): Tuples (video_id, transcript_en, transcript_de,
+                has_transcript, no_transcript_reason)
+        """
+        for i in range(0, len(updates), MAX_UPDATE_ROWS):
+            chunk = updates[i : i + MAX_UPDATE_ROWS]
+            values = ", ".join(["(?, ?, ?, ?, ?)"] * len(chunk))
+            query = f"""
+            UPDATE target
+            SET target.transcript_en = source.transcript_en,
+                target.transcript_de = source.transcript_de,
+                target.has_transcript = source.has_transcript,
+                target.no_transcript_reason = source.no_transcript_reason
+            FROM {self.table} AS target
+            JOIN (VALUES {values}) AS source (
+                id, transcript_en, transcript_de, has_transcript, no_transcript_reason
+            ) ON target.id = source.id
+            """
+            cursor.execute(query, [value for update in chunk for value in update])
+
+    def get_sound_transcript(self, sound_id: int) -> dict | None:
+        """
+        Get the transcript of a video with the given sound, if the sound is not original
+        Videos with a non-original sound share its audio and thereby its transcript.
+        Args:
+            sound_id (int): The sound ID
+        Returns:
+            dict: The transcripts with possible keys 'eng-US' and 'deu-DE', or None if the
+                sound is original or no video with the sound has a transcript yet
+        """
+        with pyodbc.connect(self.connection_str) as cnxn:
+            cursor = cnxn.cursor()
+            query = f"""
+            SELECT TOP 1 video.transcript_en, video.transcript_de
+            FROM {self.table} AS video
+            JOIN [dbo].[Sounds] AS sound ON sound.id = video.sound_id
+            WHERE video.sound_id = ? AND sound.original_sound = 0 AND video.has_transcript = 1
+            """
+            cursor.execute(query, sound_id)
+            row = cursor.fetchone()
+            if row is None:
+                return None
+            transcripts = {"eng-US": row.transcript_en, "deu-DE": row.transcript_de}
+            return {language: text for language, text in transcripts.items() if text}
 
     def update_core_messages(
         self,
@@ -299,3 +529,92 @@ class DBConnector:
             cursor.execute(query)
             rows = cursor.fetchall()
             return rows
+
+
+def _transcribe_row(video_id: int, url: str, disable_azure: bool = True) -> tuple:
+    """
+    Fetch the details of a video and get its transcripts
+    Args:
+        video_id (int): The video ID
+        url (str): The url of the video
+        disable_azure (bool): Do not fall back to Azure Speech to Text
+    Returns:
+        tuple: The outcome for the StatCollector ("success", "private", "failed" or None) and
+            the values (transcript_en, transcript_de, has_transcript, no_transcript_reason)
+            to update the row with
+    """
+    try:
+        tt_obj = TiktokVideoDetails(url=url)
+    except VideoIsPrivateError as error:
+        LOG.info("Video is private", extra={"video_id": video_id})
+        return "private", (None, None, False, str(error))
+    except (RequestReturnedNoneError, HTTPRequestError) as error:
+        LOG.info("Video request returned None", extra={"video_id": video_id})
+        return "failed", (None, None, False, str(error))
+    except Exception as error:
+        LOG.exception(
+            "\nUnexpected Exception occured: %s",
+            error,
+            extra={"video_id": video_id},
+        )
+        return "failed", (None, None, False, str(error))
+
+    try:
+        transcriptions = tt_obj.get_transcriptions(disable_azure=disable_azure)
+    except Exception as error:
+        LOG.exception(
+            "Unexpected error when getting transcripts: %s",
+            error,
+            extra={"video_id": video_id},
+        )
+        # ? stats.add_failed_request(url)
+        return None, (None, None, False, str(error))
+
+    if not transcriptions:
+        LOG.debug("Video has no transcription", extra={"video_id": video_id})
+        return None, (None, None, False, "No transcription provided by Tiktok")
+
+    LOG.debug("Video transcripts added succesfully", extra={"video_id": video_id})
+    return "success", (
+        transcriptions.get("eng-US", None),
+        transcriptions.get("deu-DE", None),
+        True,
+        None,
+    )
+
+
+def _transcribe_rows(rows, workers: int, disable_azure: bool = True):
+    """
+    Transcribe videos, in a thread pool if there are several workers
+    At most two videos per worker are in flight, so an interrupted run leaves little work
+    behind and results are written while the pool keeps fetching.
+    Args:
+        rows (Iterable): Rows with an id and a url column
+        workers (int): Number of videos fetched and transcribed at the same time
+        disable_azure (bool): Do not fall back to Azure Speech to Text
+    Yields:
+        tuple: video ID, url, outcome and values as returned by _transcribe_row, in the
+            order the videos finish
+    """
+    if workers == 1:
+        for row in rows:
+            yield (row.id, row.url, *_transcribe_row(row.id, row.url, disable_azure))
+        return
+
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="transcriber")
+    try:
+        pending = {}
+        rows = iter(rows)
+        while True:
+            for row in itertools.islice(rows, 2 * workers - len(pending)):
+                future = executor.submit(_transcribe_row, row.id, row.url, disable_azure)
+                pending[future] = (row.id, row.url)
+            if not pending:
+                break
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                video_id, url = pending.pop(future)
+                yield (video_id, url, *future.result())
+    finally:
+        # on an interruption, only the videos that are already being fetched are finished
+        executor.shutdown(wait=False, cancel_futures=True)
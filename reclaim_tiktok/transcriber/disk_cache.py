@@ -0,0 +1,170 @@
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+import zlib
+
+LOG = logging.getLogger("reclaim_tiktok")
+
+DEFAULT_CACHE_PATH = "transcriber_cache.sqlite"
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+DEFAULT_TTL = 30 * 24 * 60 * 60
+# Entries evicted at once when the cache is over its size
+EVICTION_BATCH = 100
+
+
+class DiskCache:
+    """Content-addressed on-disk cache of transcripts and Tiktok page data
+
+    Values are stored JSON-encoded and compressed in a SQLite file in WAL
+    mode, so several transcription processes on one machine share it.
+    Entries are addressed by the SHA-256 of their namespace and key, expire
+    after their TTL and, once the cache exceeds ``max_bytes``, the least
+    recently used ones are evicted.
+    """
+
+    def __init__(
+        self,
+        path: str = DEFAULT_CACHE_PATH,
+        max_bytes: int = DEFAULT_MAX_BYTES,
+        ttl: float = DEFAULT_TTL,
+    ) -> None:
+        """
+        Params
+        ---
+        :param path: path to the SQLite file (created on first use), the
+            cache is disabled if empty or None
+        :param max_bytes: compressed size of all values above which the
+            least recently used entries are evicted
+        :param ttl: default seconds after which an entry expires
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._cnxn = None
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._cnxn is None:
+            self._cnxn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self._cnxn.execute("PRAGMA journal_mode=WAL")
+            self._cnxn.execute("PRAGMA synchronous=NORMAL")
+            self._cnxn.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                "key TEXT PRIMARY KEY, namespace TEXT NOT NULL, value BLOB NOT NULL, "
+                "size INTEGER NOT NULL, expires_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            self._cnxn.execute(
+                "CREATE INDEX IF NOT EXISTS entries_accessed_at ON entries (accessed_at)"
+            )
+            self._cnxn.commit()
+            row = self._cnxn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()
+            self._total_bytes = row[0]
+        return self._cnxn
+
+    @staticmethod
+    def _address(namespace: str, key) -> str:
+        return hashlib.sha256(f"{namespace}\0{key}".encode()).hexdigest()
+
+    def get(self, namespace: str, key):
+        """Gets a value from the cache
+
+        Params
+        ---
+        :param namespace: kind of the value, e.g. ``"transcriptions"``
+        :param key: key of the value within the namespace, e.g. a video id
+
+        Returns
+        ---
+        :returns: the cached value, or None if it is missing or expired
+        """
+        if not self.path:
+            return None
+        address = self._address(namespace, key)
+        now = time.time()
+        with self._lock:
+            cnxn = self._connection()
+            row = cnxn.execute(
+                "SELECT value FROM entries WHERE key = ? AND expires_at > ?", (address, now)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            cnxn.execute("UPDATE entries SET accessed_at = ? WHERE key = ?", (now, address))
+            cnxn.commit()
+            self.hits += 1
+        return json.loads(zlib.decompress(row[0]))
+
+    def set(self, namespace: str, key, value, ttl: float = None) -> None:
+        """Stores a value in the cache
+
+        Params
+        ---
+        :param namespace: kind of the value, e.g. ``"transcriptions"``
+        :param key: key of the value within the namespace, e.g. a video id
+        :param value: JSON-serializable value
+        :param ttl: seconds after which the entry expires, defaults to the
+            TTL of the cache
+        """
+        if not self.path:
+            return
+        address = self._address(namespace, key)
+        blob = zlib.compress(json.dumps(value, ensure_ascii=False).encode("utf-8"))
+        now = time.time()
+        with self._lock:
+            cnxn = self._connection()
+            old = cnxn.execute("SELECT size FROM entries WHERE key = ?", (address,)).fetchone()
+            cnxn.execute(
+                "INSERT OR REPLACE INTO entries "
+                "(key, namespace, value, size, expires_at, accessed_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (address, namespace, blob, len(blob), now + (ttl or self.ttl), now),
+            )
+            self._total_bytes += len(blob) - (old[0] if old else 0)
+            if self._total_bytes > self.max_bytes:
+                self._evict(now)
+            cnxn.commit()
+
+    def _evict(self, now: float) -> None:
+        cnxn = self._cnxn
+        cnxn.execute("DELETE FROM entries WHERE expires_at <= ?", (now,))
+        row = cnxn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()
+        self._total_bytes = row[0]
+        evicted = 0
+        while self._total_bytes > self.max_bytes:
+            rows = cnxn.execute(
+                "SELECT key, size FROM entries ORDER BY accessed_at LIMIT ?", (EVICTION_BATCH,)
+            ).fetchall()
+            if not rows:
+                break
+            for key, size in rows:
+                if self._total_bytes <= self.max_bytes:
+                    break
+                cnxn.execute("DELETE FROM entries WHERE key = ?", (key,))
+                self._total_bytes -= size
+                evicted += 1
+        LOG.debug("Evicted %d least recently used cache entries", evicted)
+
+    def print_stats(self) -> None:
+        """Prints how many lookups the on-disk cache answered"""
+        if not self.hits + self.misses:
+            return
+        print("Disk cache hits: ", self.hits)
+        print("Disk cache misses: ", self.misses)
+        print("Disk cache hit ratio: %.1f%%" % (100 * self.hits / (self.hits + self.misses)))
+
+    def close(self) -> None:
+        """Closes the connection to the SQLite file"""
+        with self._lock:
+            if self._cnxn is not None:
+                self._cnxn.close()
+                self._cnxn = None
+
+
+# Shared by TiktokVideoDetails page requests, subtitles and Azure transcriptions
+DISK_CACHE = DiskCache()
@@ -0,0 +1,129 @@
+import logging
+import threading
+import time
+
+import browser_cookie3
+import requests
+from requests.adapters import HTTPAdapter
+from requests.cookies import RequestsCookieJar
+
+LOG = logging.getLogger("reclaim_tiktok")
+
+BROWSER_NAME = "chrome"
+COOKIE_DOMAIN = "www.tiktok.com"
+# Browser cookies are reloaded after this many seconds even if none has expired
+COOKIE_MAX_AGE = 60 * 60
+# Rejected requests reload the browser cookies at most once per this many seconds
+COOKIE_MIN_RELOAD_INTERVAL = 60
+# Connections kept alive per host, should be at least the number of transcription workers
+POOL_MAXSIZE = 32
+
+
+class HTTPClient:
+    """Process-wide, thread-safe HTTP client for Tiktok pages, subtitles
+    and video files
+
+    ``requests.Session`` is not guaranteed to be thread-safe, so every
+    thread gets its own session. They all mount one ``HTTPAdapter``, whose
+    urllib3 connection pool is thread-safe, so connections are kept alive
+    and reused across threads instead of paying a TCP and TLS handshake
+    per request. The Tiktok cookies are decrypted from the browser once
+    and reloaded only when one of them expires, ``COOKIE_MAX_AGE`` has
+    passed or Tiktok rejected them (at most once per
+    ``COOKIE_MIN_RELOAD_INTERVAL``). They are never added to the session
+    jars and are only sent with ``with_cookies=True``; a reload swaps in
+    a new jar instead of changing the one other threads may be sending.
+    """
+
+    def __init__(
+        self,
+        browser_name: str = BROWSER_NAME,
+        cookie_domain: str = COOKIE_DOMAIN,
+        cookie_max_age: float = COOKIE_MAX_AGE,
+        pool_maxsize: int = POOL_MAXSIZE,
+        cookie_min_reload_interval: float = COOKIE_MIN_RELOAD_INTERVAL,
+    ) -> None:
+        """
+        Params
+        ---
+        :param browser_name: browser to load the cookies from, as named
+            by ``browser_cookie3``
+        :param cookie_domain: domain of the cookies to load
+        :param cookie_max_age: seconds after which the cookies are reloaded
+        :param pool_maxsize: connections kept alive per host
+        :param cookie_min_reload_interval: seconds during which
+            ``expire_cookies`` does not reload freshly loaded cookies again
+        """
+        self.browser_name = browser_name
+        self.cookie_domain = cookie_domain
+        self.cookie_max_age = cookie_max_age
+        self.cookie_min_reload_interval = cookie_min_reload_interval
+
+        self.adapter = HTTPAdapter(pool_connections=8, pool_maxsize=pool_maxsize)
+        self._local = threading.local()
+
+        self._cookies = RequestsCookieJar()
+        self._cookies_expire_at = 0.0
+        self._cookies_loaded_at = None
+        self._cookie_lock = threading.Lock()
+
+    @property
+    def session(self) -> requests.Session:
+        """The session of the calling thread"""
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = requests.Session()
+            session.mount("https://", self.adapter)
+            session.mount("http://", self.adapter)
+            self._local.session = session
+        return session
+
+    def get(self, url: str, with_cookies: bool = False, **kwargs) -> requests.Response:
+        """Sends a GET request over the shared session
+
+        Params
+        ---
+        :param url: the url to request
+        :param with_cookies: send the browser cookies, (re)loading them if
+            needed, unless ``cookies`` are given
+        :param kwargs: passed on to ``requests.Session.get``
+        """
+        if with_cookies and kwargs.get("cookies") is None:
+            self.ensure_cookies()
+            kwargs["cookies"] = self._cookies
+        return self.session.get(url, **kwargs)
+
+    def ensure_cookies(self) -> None:
+        """(Re)loads the browser cookies if they were never loaded, one
+        of them expired or they are older than ``cookie_max_age``
+        """
+        if time.time() < self._cookies_expire_at:
+            return
+        with self._cookie_lock:
+            # another thread may have reloaded them while we waited
+            if time.time() < self._cookies_expire_at:
+                return
+            LOG.debug("Loading %s cookies for %s", self.browser_name, self.cookie_domain)
+            cookies = getattr(browser_cookie3, self.browser_name)(domain_name=self.cookie_domain)
+            jar = RequestsCookieJar()
+            jar.update(cookies)
+            self._cookies = jar
+            now = time.time()
+            self._cookies_loaded_at = now
+            expiries = [cookie.expires for cookie in cookies if (cookie.expires or 0) > now]
+            self._cookies_expire_at = min([now + self.cookie_max_age, *expiries])
+
+    def expire_cookies(self) -> None:
+        """Forces a reload of the browser cookies on the next request,
+        e.g. after Tiktok rejected a request, unless they were loaded less
+        than ``cookie_min_reload_interval`` seconds ago
+        """
+        with self._cookie_lock:
+            loaded_at = self._cookies_loaded_at
+            if loaded_at and time.time() - loaded_at < self.cookie_min_reload_interval:
+                return
+            self._cookies_expire_at = 0.0
+
+
+# Shared by all TiktokVideoDetails instances and the AzureConnector
+HTTP_CLIENT = HTTPClient()
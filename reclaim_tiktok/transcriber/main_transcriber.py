@@ -4,6 +4,8 @@ import time
 import numpy as np
 import pandas as pd
 
+from reclaim_tiktok.transcriber.disk_cache import DISK_CACHE
+from reclaim_tiktok.transcriber.sound_cache import SOUND_TRANSCRIPTS
 from reclaim_tiktok.transcriber.tiktok_video_details import (
     HTTPRequestError,
     RequestReturnedNoneError,
@@ -155,6 +157,8 @@ def save_tiktok_info_to_existing_csv(csv_filename: str) -> None:
         print("\nUnexpected Exception occurred:", error)
     finally:
         stats.print_stats()
+        SOUND_TRANSCRIPTS.print_stats()
+        DISK_CACHE.print_stats()
 
         target_filename = os.path.splitext(csv_filename)[0] + "_transcribed_copy.csv"
         new_df = df.assign(
@@ -0,0 +1,120 @@
+import logging
+import threading
+from collections.abc import Callable
+
+from reclaim_tiktok.transcriber.disk_cache import DISK_CACHE, DiskCache
+
+LOG = logging.getLogger("reclaim_tiktok")
+
+
+class SoundTranscriptCache:
+    """Transcripts of non-original sounds, shared by all videos using them
+
+    Videos with a non-original sound (trending audio, music) all have the
+    audio of that sound, so it only needs to be downloaded and sent to
+    Azure Speech once. Transcripts are kept in memory per sound id; on a
+    miss the local ``disk_cache`` and then the optional ``lookup`` (e.g.
+    ``DBConnector.get_sound_transcript``) are asked before transcribing.
+    Empty transcripts are not kept, as they may come from a failed Azure
+    request. Concurrent workers asking for the same sound wait for the
+    first one instead of transcribing it twice.
+    """
+
+    def __init__(
+        self, lookup: Callable[[int], dict | None] = None, disk_cache: DiskCache = None
+    ) -> None:
+        """
+        Params
+        ---
+        :param lookup: function returning the stored transcript of a sound
+            id, or None if there is none
+        :param disk_cache: DiskCache keeping the transcripts across runs
+            in its ``"sounds"`` namespace
+        """
+        self.lookup = lookup
+        self.disk_cache = disk_cache
+        self.hits = 0
+        self.disk_hits = 0
+        self.lookup_hits = 0
+        self.misses = 0
+        self._transcripts = {}
+        self._sound_locks = {}
+        self._lock = threading.Lock()
+
+    def get_or_transcribe(self, sound_id: int, transcribe: Callable[[], dict]) -> dict:
+        """Gets the transcript of a sound, transcribing it on a miss
+
+        Params
+        ---
+        :param sound_id: id of the (non-original) sound
+        :param transcribe: function transcribing the audio of the sound
+
+        Returns
+        ---
+        :returns: dict with possible keys 'eng-US', 'deu-DE' or empty
+        """
+        with self._lock:
+            if sound_id in self._transcripts:
+                self.hits += 1
+                return dict(self._transcripts[sound_id])
+            sound_lock = self._sound_locks.setdefault(sound_id, threading.Lock())
+
+        with sound_lock:
+            with self._lock:
+                # transcribed by another worker while we waited
+                if sound_id in self._transcripts:
+                    self.hits += 1
+                    return dict(self._transcripts[sound_id])
+
+            try:
+                transcript = self._load(sound_id)
+                if not transcript:
+                    transcript = transcribe()
+                    with self._lock:
+                        self.misses += 1
+                    if transcript and self.disk_cache:
+                        self.disk_cache.set("sounds", sound_id, transcript)
+            finally:
+                with self._lock:
+                    self._sound_locks.pop(sound_id, None)
+
+            if transcript:
+                with self._lock:
+                    self._transcripts[sound_id] = dict(transcript)
+            return transcript
+
+    def _load(self, sound_id: int) -> dict | None:
+        # the local cache first, it saves the round trip to the database
+        if self.disk_cache and (transcript := self.disk_cache.get("sounds", sound_id)):
+            with self._lock:
+                self.disk_hits += 1
+            return transcript
+        if self.lookup and (transcript := self.lookup(sound_id)):
+            with self._lock:
+                self.lookup_hits += 1
+            if self.disk_cache:
+                self.disk_cache.set("sounds", sound_id, transcript)
+            return transcript
+        return None
+
+    @property
+    def hit_ratio(self) -> float:
+        """Share of the requests that did not need a transcription"""
+        reused = self.hits + self.disk_hits + self.lookup_hits
+        requests = reused + self.misses
+        return reused / requests if requests else 0.0
+
+    def print_stats(self) -> None:
+        """Prints how many sound transcriptions were reused"""
+        reused = self.hits + self.disk_hits + self.lookup_hits
+        if not reused + self.misses:
+            return
+        print("Sound transcripts reused: ", reused)
+        print("Sound transcripts from the disk cache: ", self.disk_hits)
+        print("Sound transcripts looked up: ", self.lookup_hits)
+        print("Sounds transcribed: ", self.misses)
+        print("Sound transcript hit ratio: %.1f%%" % (self.hit_ratio * 100))
+
+
+# Shared by all TiktokVideoDetails instances of the process
+SOUND_TRANSCRIPTS = SoundTranscriptCache(disk_cache=DISK_CACHE)
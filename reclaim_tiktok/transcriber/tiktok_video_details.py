@@ -1,27 +1,31 @@
-import io
+import contextlib
+import itertools
 import json
 import logging
 import os
 import re
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from urllib.parse import urlparse
 
-import browser_cookie3
 import numpy as np
 import pandas as pd
 import pyktok as pyk
-import requests
-import webvtt
 from bs4 import BeautifulSoup
-from moviepy.editor import VideoFileClip
 from requests.exceptions import ReadTimeout, SSLError
 
-from reclaim_tiktok.transcriber.azure_connector import AzureConnector
+from reclaim_tiktok.transcriber.azure_connector import PCM_SAMPLE_RATE, AzureConnector
+from reclaim_tiktok.transcriber.disk_cache import DISK_CACHE
+from reclaim_tiktok.transcriber.http_client import HTTP_CLIENT
+from reclaim_tiktok.transcriber.sound_cache import SOUND_TRANSCRIPTS
 
 pyk.specify_browser("chrome")
 
 LOG = logging.getLogger("reclaim_tiktok")
 
-BROWSER_NAME = "chrome"
-
 headers = {
     "Accept-Encoding": "gzip, deflate, sdch",
     "Accept-Language": "en-US,en;q=0.8",
@@ -33,6 +37,340 @@ headers = {
 }
 
 
+# Requests per second sent to a single host (www.tiktok.com, the subtitle CDN, ...)
+# by all threads of the process together, when transcribing with several workers
+DEFAULT_REQUESTS_PER_SECOND_PER_HOST = 5.0
+
+
+class HostRateLimiter:
+    """Spaces out the requests of all threads to the same host, so that
+    concurrent workers do not get throttled or blocked by Tiktok
+    """
+
+    def __init__(self, requests_per_second: float = DEFAULT_REQUESTS_PER_SECOND_PER_HOST) -> None:
+        """
+        Params
+        ---
+        :param requests_per_second: maximum number of requests per second
+            sent to one host, no limit if None
+        """
+        self.requests_per_second = requests_per_second
+        self._next_request_at = {}
+        self._lock = threading.Lock()
+
+    def wait(self, url: str) -> None:
+        """Blocks until a request to the host of ``url`` may be sent
+
+        Params
+        ---
+        :param url: the url that is about to be requested
+        """
+        if not self.requests_per_second:
+            return
+        host = urlparse(url).netloc
+        with self._lock:
+            now = time.monotonic()
+            request_at = max(now, self._next_request_at.get(host, now))
+            self._next_request_at[host] = request_at + 1 / self.requests_per_second
+        if request_at > now:
+            time.sleep(request_at - now)
+
+    @contextlib.contextmanager
+    def limit(self, requests_per_second: float):
+        """Limits the requests per second to one host until the end of the
+        ``with`` block, then restores the previous limit
+
+        Params
+        ---
+        :param requests_per_second: maximum number of requests per second
+            sent to one host, no limit if None
+        """
+        previous = self.requests_per_second
+        self.requests_per_second = requests_per_second
+        try:
+            yield self
+        finally:
+            self.requests_per_second = previous
+
+
+# Shared by all TiktokVideoDetails instances of the process, only limits requests
+# within HOST_RATE_LIMITER.limit() (e.g. DBConnector.update_transcript_multiple)
+HOST_RATE_LIMITER = HostRateLimiter(requests_per_second=None)
+
+REHYDRATION_SCRIPT_ID = "__UNIVERSAL_DATA_FOR_REHYDRATION__"
+VIDEO_DETAIL_KEY = '"webapp.video-detail"'
+_JSON_KEY_SEPARATOR = re.compile(r"\s*:\s*")
+_JSON_DECODER = json.JSONDecoder()
+# The video urls in a cached page are signed and expire after a few hours
+PAGE_CACHE_TTL = 60 * 60
+
+
+def parse_rehydration_json(html: str) -> dict | None:
+    """Gets the rehydration data of a Tiktok video page
+
+    Only the ``"webapp.video-detail"`` entry is decoded, located with
+    plain string searches instead of parsing the page into a DOM. If the
+    page does not look as expected, it falls back to BeautifulSoup.
+
+    Params
+    ---
+    :param html: the html of a Tiktok video page
+
+    Returns
+    ---
+    :returns: dict ``{"__DEFAULT_SCOPE__": {"webapp.video-detail": ...}}``
+        (all of the rehydration data if the video detail entry is
+        missing), or None if the page has no rehydration data
+    """
+    try:
+        return _parse_rehydration_json_fast(html)
+    except ValueError as error:
+        LOG.debug("Falling back to BeautifulSoup for the rehydration data: %s", error)
+        return _parse_rehydration_json_soup(html)
+
+
+def _parse_rehydration_json_fast(html: str) -> dict | None:
+    tag_start = html.find(f'id="{REHYDRATION_SCRIPT_ID}"')
+    if tag_start == -1:
+        if REHYDRATION_SCRIPT_ID not in html:
+            return None
+        # e.g. id='...', id=... or id = "...", left to BeautifulSoup
+        raise ValueError("Rehydration script id is not written as expected")
+    script_start = html.find(">", tag_start) + 1
+    script_end = html.find("</script>", script_start)
+    if script_start == 0 or script_end == -1:
+        raise ValueError("Unterminated rehydration script")
+
+    key_start = html.find(VIDEO_DETAIL_KEY, script_start, script_end)
+    if key_start == -1:
+        return json.loads(html[script_start:script_end])
+    colon = _JSON_KEY_SEPARATOR.match(html, key_start + len(VIDEO_DETAIL_KEY))
+    if colon is None:
+        raise ValueError("Video detail key is not followed by a value")
+    video_detail, end = _JSON_DECODER.raw_decode(html, colon.end())
+    if end > script_end:
+        raise ValueError("Video detail value runs past the rehydration script")
+    return {"__DEFAULT_SCOPE__": {"webapp.video-detail": video_detail}}
+
+
+def _parse_rehydration_json_soup(html: str) -> dict | None:
+    soup = BeautifulSoup(html, "html.parser")
+    tt_script = soup.find("script", attrs={"id": REHYDRATION_SCRIPT_ID})
+    if tt_script is None:
+        return
+    tt_json = json.loads(tt_script.string)
+    return tt_json
+
+
+VTT_HEADER = "WEBVTT"
+# Same cue timing, timestamp and tag syntax as webvtt-py, so transcripts do not change
+_VTT_CUE_TIMINGS = re.compile(
+    r"\s*((?:\d+:)?\d{2}:\d{2}.\d{3})\s*-->\s*((?:\d+:)?\d{2}:\d{2}.\d{3})"
+)
+_VTT_TIMESTAMP = re.compile(r"(?:(\d{1,2}):)?(\d{1,2}):(\d{1,2})\.(\d{3})")
+# Timings whose timestamps need no further validation, i.e. those of nearly all cues
+_VTT_VALID_TIMINGS = re.compile(
+    r"\s*(?:\d{1,2}:)?[0-5]\d:[0-5]\d\.\d{3}\s*-->\s*(?:\d{1,2}:)?[0-5]\d:[0-5]\d\.\d{3}"
+)
+_VTT_CUE_TAGS = re.compile("<.*?>")
+
+
+def vtt_to_transcript(vtt: str) -> str | None:
+    """Gets the transcript of WebVTT subtitles
+
+    The subtitles are read in one pass over their lines, without building
+    caption objects: the text of every cue, without cue tags and followed
+    by a space, is collected and joined once at the end. Cues with invalid
+    timestamps are skipped instead of failing the whole track.
+
+    Params
+    ---
+    :param vtt: the content of a WebVTT file
+
+    Returns
+    ---
+    :returns: the text of all cues, or None if ``vtt`` is not WebVTT
+    """
+    if not vtt.startswith(VTT_HEADER, 1 if vtt.startswith("\ufeff") else 0):
+        return None
+    parts = []
+    block = []
+    for line in itertools.chain(vtt.split("\n"), [""]):
+        line = line.rstrip("\r")
+        if line.strip():
+            block.append(line)
+        elif block:
+            if (text := _vtt_cue_text(block)) is not None:
+                # Some captions require an extra space in between
+                parts.append(text)
+                parts.append(" ")
+            block = []
+    return "".join(parts)
+
+
+def _vtt_cue_text(block: list) -> str | None:
+    # a cue is its timings, optionally preceded by an identifier, and at least one text line
+    if _VTT_CUE_TIMINGS.match(block[0]):
+        timings_line = 0
+    elif len(block) > 2 and "-->" not in block[0] and _VTT_CUE_TIMINGS.match(block[1]):
+        timings_line = 1
+    else:
+        return None  # header, NOTE or STYLE block
+    timings = block[timings_line]
+    payload = block[timings_line + 1 :]
+    if not payload or "-->" in payload[0]:
+        return None
+
+    text = "\n".join(payload)
+    if "-->" in text:
+        # like webvtt-py, later timings lines replace the first ones and are not text
+        text_lines = []
+        for line in payload:
+            if _VTT_CUE_TIMINGS.match(line):
+                timings = line
+            else:
+                text_lines.append(line)
+        text = "\n".join(text_lines)
+    if not _VTT_VALID_TIMINGS.match(timings):
+        for timestamp in _VTT_CUE_TIMINGS.match(timings).groups():
+            match = _VTT_TIMESTAMP.match(timestamp)
+            if not match or int(match.group(2)) > 59 or int(match.group(3)) > 59:
+                LOG.debug("Skipping WebVTT cue with invalid timestamp %r", timestamp)
+                return None
+    return _VTT_CUE_TAGS.sub("", text) if "<" in text else text
+
+
+# Bytes read from the download and from the audio decoder at once
+AUDIO_CHUNK_SIZE = 64 * 1024
+# Bytes of a downloaded video kept in memory for a retry from a file, before spilling to disk
+VIDEO_SPOOL_SIZE = 64 * 1024 * 1024
+
+
+def decode_audio_to_pcm(video_chunks, sample_rate: int = PCM_SAMPLE_RATE):
+    """Decodes the audio track of a video with ffmpeg, in memory if possible
+
+    The video bytes are piped into ffmpeg by a background thread while
+    the decoded audio is read from its output, so decoding starts with
+    the first downloaded chunk. This needs the index of the mp4 at its
+    start ("faststart"), as Tiktok usually serves it. Otherwise ffmpeg
+    fails or decodes no audio from the pipe, and the video, of which a
+    copy is kept while it is piped, is decoded again from a temporary
+    file.
+
+    Params
+    ---
+    :param video_chunks: iterable of bytes of the video file
+    :param sample_rate: samples per second of the decoded audio
+
+    Yields
+    ---
+    :yields: bytes of mono 16 bit little endian PCM audio
+    """
+    with tempfile.SpooledTemporaryFile(max_size=VIDEO_SPOOL_SIZE) as video:
+
+        def copy_chunks():
+            for chunk in video_chunks:
+                video.write(chunk)
+                yield chunk
+
+        piped_chunks = copy_chunks()
+        decoded = False
+        try:
+            for chunk in _run_ffmpeg("pipe:0", sample_rate, piped_chunks):
+                decoded = True
+                yield chunk
+        except AudioDecodingError as error:
+            if decoded:
+                raise
+            LOG.debug("Decoding the piped video failed, decoding it from a file: %s", error)
+        if decoded:
+            return
+
+        # ffmpeg may have stopped reading early: finish the copy of the download
+        for _ in piped_chunks:
+            pass
+        video.seek(0)
+        with tempfile.NamedTemporaryFile(suffix=".mp4", delete=False) as video_file:
+            shutil.copyfileobj(video, video_file)
+        try:
+            yield from _run_ffmpeg(video_file.name, sample_rate)
+        finally:
+            os.remove(video_file.name)
+
+
+def _run_ffmpeg(input_url: str, sample_rate: int, video_chunks=None):
+    """Decodes the audio track of a video file or of ``video_chunks``
+    piped to ``pipe:0`` into mono 16 bit little endian PCM
+
+    stdin is written and stderr read by background threads, so ffmpeg
+    never blocks on a full pipe while its output is read.
+    """
+    ffmpeg = os.environ.get("IMAGEIO_FFMPEG_EXE", "ffmpeg")
+    process = subprocess.Popen(
+        [
+            ffmpeg,
+            "-loglevel",
+            "error",
+            "-i",
+            input_url,
+            "-vn",
+            "-f",
+            "s16le",
+            "-acodec",
+            "pcm_s16le",
+            "-ac",
+            "1",
+            "-ar",
+            str(sample_rate),
+            "pipe:1",
+        ],
+        stdin=subprocess.DEVNULL if video_chunks is None else subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+    write_errors = []
+    stderr_lines = []
+
+    def write_video():
+        try:
+            for chunk in video_chunks:
+                process.stdin.write(chunk)
+        except BrokenPipeError:
+            # ffmpeg stopped reading, its exit code tells why
+            pass
+        except Exception as error:
+            write_errors.append(error)
+        finally:
+            try:
+                process.stdin.close()
+            except BrokenPipeError:
+                pass
+
+    def read_stderr():
+        for line in process.stderr:
+            stderr_lines.append(line.decode(errors="replace"))
+
+    threads = [threading.Thread(target=read_stderr, daemon=True)]
+    if video_chunks is not None:
+        threads.append(threading.Thread(target=write_video, daemon=True))
+    for thread in threads:
+        thread.start()
+    try:
+        while chunk := process.stdout.read(AUDIO_CHUNK_SIZE):
+            yield chunk
+    finally:
+        process.stdout.close()
+        for thread in threads:
+            thread.join()
+        process.stderr.close()
+        returncode = process.wait()
+    if write_errors:
+        raise write_errors[0]
+    if returncode != 0:
+        stderr = "".join(stderr_lines).strip()
+        raise AudioDecodingError(f"\nffmpeg could not decode the audio: {stderr}")
+
+
 class VideoIsPrivateError(Exception):
     """Raised when a tiktok video's details are not present"""
 
@@ -55,6 +393,12 @@ class HTTPRequestError(Exception):
     pass
 
 
+class AudioDecodingError(Exception):
+    """Raised when the audio of a tiktok video could not be decoded"""
+
+    pass
+
+
 class TiktokVideoDetails:
     """Creates an instance of a tiktok object, which allows easy methods
     of obtaining information pertaining to the video linked by the
@@ -69,7 +413,6 @@ class TiktokVideoDetails:
         """
         self.transcription_source: str
         self.transcriptions: dict = None
-        self.cookies = None
         self.url = url
         retries = 3
         while retries > 0:
@@ -125,17 +468,22 @@ class TiktokVideoDetails:
             break
 
     def _get_tiktok_json(self, video_url) -> dict | None:
-        if self.cookies is None:
-            self.cookies = getattr(browser_cookie3, BROWSER_NAME)(domain_name="www.tiktok.com")
-        tt = requests.get(video_url, headers=headers, cookies=self.cookies, timeout=20)
+        if (tt_json := DISK_CACHE.get("pages", video_url)) is not None:
+            return tt_json
+        HOST_RATE_LIMITER.wait(video_url)
+        tt = HTTP_CLIENT.get(video_url, with_cookies=True, headers=headers, timeout=20)
         if tt.status_code != 200:
+            if tt.status_code in (401, 403):
+                # the cookies may have been invalidated, reload them for the retry
+                HTTP_CLIENT.expire_cookies()
             raise HTTPRequestError
-        soup = BeautifulSoup(tt.text, "html.parser")
-        tt_script = soup.find("script", attrs={"id": "__UNIVERSAL_DATA_FOR_REHYDRATION__"})
-        if tt_script is None:
-            return
-        tt_json = json.loads(tt_script.string)
-        self.cookies = tt.cookies
+        tt_json = parse_rehydration_json(tt.text)
+        video_detail = (tt_json or {}).get("__DEFAULT_SCOPE__", {}).get("webapp.video-detail")
+        # private or removed videos are requested again on the next run
+        if video_detail and "itemStruct" in video_detail.get("itemInfo", {}):
+            # only the video detail is used, the rest of the page is not cached
+            tt_json = {"__DEFAULT_SCOPE__": {"webapp.video-detail": video_detail}}
+            DISK_CACHE.set("pages", video_url, tt_json, ttl=PAGE_CACHE_TTL)
         return tt_json
 
     @property
@@ -161,11 +509,19 @@ class TiktokVideoDetails:
         list as original. Returns ``False`` otherwise.
         """
         if sound_is_original := self.details["music"].get("original"):
-            return eval(sound_is_original.title())
-        music_author_name = self.details["music"]["authorName"]
-        video_author_nickname = self.details["author"]["nickname"]
+            if isinstance(sound_is_original, str):
+                return sound_is_original.lower() == "true"
+            return bool(sound_is_original)
+        music_author_name = self.details["music"].get("authorName")
+        video_author_nickname = self.details["author"].get("nickname")
         return music_author_name == video_author_nickname
 
+    @property
+    def sound_id(self) -> int | None:
+        """The id of the sound of the video, None if it has none"""
+        sound_id = self.details.get("music", {}).get("id")
+        return int(sound_id) if sound_id else None
+
     @property
     def download_url(self) -> str:
         """The url to use when downloading the video."""
@@ -187,6 +543,9 @@ class TiktokVideoDetails:
 
         If none are present and ``disable_azure=False``, then the video
         is downloaded and sent to Azure Speech to Text for transcribing.
+        Azure transcripts of non-original sounds are reused for all videos
+        with the same sound (see ``SOUND_TRANSCRIPTS``). Transcripts are
+        kept in ``DISK_CACHE``, so reruns do not download them again.
 
         Params
         ---
@@ -203,32 +562,44 @@ class TiktokVideoDetails:
             "Chrome/123.0.0.0 Safari/537.36"
         )
         headers = {"User-Agent": user_agent}
+        if (cached := DISK_CACHE.get("transcriptions", self.video_id)) is not None:
+            self.transcriptions = cached["transcriptions"]
+            self.transcription_source = cached["source"]
+            return self.transcriptions
         self.transcriptions = {}
 
         for info in self.details["video"].get("subtitleInfos", []):
             if (language := info["LanguageCodeName"]) in ["eng-US", "deu-DE"] and info[
                 "Format"
             ] == "webvtt":
-                result = requests.get(info["Url"], headers=headers)
+                # a partial retry reuses the tracks downloaded before the failure, while
+                # a re-published track has a new url
+                subtitle_key = info["Url"]
+                if (transcript := DISK_CACHE.get("subtitles", subtitle_key)) is not None:
+                    self.transcriptions[language] = transcript
+                    continue
+                HOST_RATE_LIMITER.wait(info["Url"])
+                result = HTTP_CLIENT.get(info["Url"], headers=headers)
                 if vtt := result.content.decode():
-                    transcript = ""
-                    try:
-                        for caption in webvtt.read_buffer(io.StringIO(vtt)):
-                            # Some captions require an extra space in between
-                            transcript += f"{caption.text} "
-                    except webvtt.MalformedFileError as error:
-                        LOG.exception(
-                            "Encountered MalfromedFileError in transcription: %s",
-                            error,
-                            {"video_url": self.url},
+                    if (transcript := vtt_to_transcript(vtt)) is None:
+                        LOG.warning(
+                            "Subtitles are not in WebVTT format",
+                            extra={"video_url": self.url, "language": language},
                         )
                         continue
                     self.transcriptions[language] = transcript
+                    DISK_CACHE.set("subtitles", subtitle_key, transcript)
 
         self.transcription_source = "Tiktok"
 
         if not self.transcriptions and not disable_azure:
-            if True:  # self.has_original_sound: # TODO Check if this is viable
+            if self.sound_id and not self.has_original_sound:
+                # the audio is the same for all videos using the sound
+                self.transcriptions = SOUND_TRANSCRIPTS.get_or_transcribe(
+                    self.sound_id, self.get_transcription_from_azure
+                )
+                self.transcription_source = "Azure Speech to Text"
+            else:  # original sound or no sound id: the audio is specific to the video
                 self.transcriptions = self.get_transcription_from_azure()
 
             # TODO
@@ -237,6 +608,13 @@ class TiktokVideoDetails:
             #       url=self.download_url)
             #     self.transcription_source = "Azure Video Indexer"
 
+        # an empty result may be an Azure error (quota, auth, network), so it is retried
+        if self.transcriptions:
+            DISK_CACHE.set(
+                "transcriptions",
+                self.video_id,
+                {"transcriptions": self.transcriptions, "source": self.transcription_source},
+            )
         return self.transcriptions
 
     def save_data_to_csv_file(self, csv_filename: str, disable_azure: bool = False) -> None:
@@ -279,32 +657,37 @@ class TiktokVideoDetails:
         """Downloads and separates the audio of a tiktok video for
         processing in Azure Speech to be trancribed.
 
+        The video is streamed from Tiktok through ffmpeg into the Speech
+        SDK without writing any file (unless its mp4 index is at the end,
+        see ``decode_audio_to_pcm``), so concurrent workers do not get in
+        each other's way.
+
         Returns
         ---
         :returns: dictionary containing possible keys 'eng-US',
             'deu-DE', or empty
         """
-        # save audio/video and perform speech to text
-        # pyktok uses the below logic to name the file
-        pyk.save_tiktok(self.url)
-        video_prefix = re.findall(pyk.url_regex, self.url)[0]
-        video_filename = video_prefix.replace("/", "_") + ".mp4"
-
-        # Get audio from tiktok
-        video_clip = VideoFileClip(video_filename)
-        audio = video_clip.audio
-        audio_filename = os.path.splitext(video_filename)[0] + ".wav"
-        audio.write_audiofile(audio_filename)
-
-        transcriptions = AzureConnector.translation_continuous_with_lid_from_multilingual_file(
-            audio_filename
+        download_url = self.download_url or self.details["video"].get("playAddr")
+        if not download_url:
+            raise HTTPRequestError("\nVideo has no download url.")
+
+        HOST_RATE_LIMITER.wait(download_url)
+        response = HTTP_CLIENT.get(
+            download_url,
+            with_cookies=True,
+            headers={**headers, "referer": "https://www.tiktok.com/"},
+            stream=True,
+            timeout=20,
         )
-
-        audio.close()
-        video_clip.close()
-
-        os.remove(video_filename)
-        os.remove(audio_filename)
+        with response:
+            if response.status_code != 200:
+                raise HTTPRequestError(
+                    f"\nVideo download failed with status {response.status_code}."
+                )
+            pcm_chunks = decode_audio_to_pcm(response.iter_content(AUDIO_CHUNK_SIZE))
+            transcriptions = AzureConnector.translation_continuous_with_lid_from_pcm_stream(
+                pcm_chunks
+            )
 
         self.transcription_source = "Azure Speech to Text"
 
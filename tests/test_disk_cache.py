@@ -0,0 +1,68 @@
+import random
+import time
+
+import pytest
+
+from reclaim_tiktok.transcriber.disk_cache import DiskCache
+
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = DiskCache(str(tmp_path / "cache.sqlite"))
+    yield cache
+    cache.close()
+
+
+def test_get_returns_the_stored_value(cache):
+    value = {"de": "Hallo zusammen", "en": "Hello everyone"}
+    cache.set("transcriptions", "7", value)
+    assert cache.get("transcriptions", "7") == value
+    assert cache.get("transcriptions", "8") is None
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_namespaces_are_separate(cache):
+    cache.set("transcriptions", "7", "transcript")
+    cache.set("sounds", "7", "sound")
+    assert cache.get("transcriptions", "7") == "transcript"
+    assert cache.get("sounds", "7") == "sound"
+
+
+def test_entries_expire(cache):
+    cache.set("pages", "url", {"a": 1}, ttl=0.05)
+    assert cache.get("pages", "url") == {"a": 1}
+    time.sleep(0.1)
+    assert cache.get("pages", "url") is None
+
+
+def test_values_survive_reopening(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    cache = DiskCache(path)
+    cache.set("transcriptions", "7", "transcript")
+    cache.close()
+
+    reopened = DiskCache(path)
+    assert reopened.get("transcriptions", "7") == "transcript"
+    reopened.close()
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    cache = DiskCache(str(tmp_path / "cache.sqlite"), max_bytes=1800)
+    # random values hardly compress: about 750 bytes each, only two fit
+    rng = random.Random(0)
+    values = {key: rng.randbytes(700).hex() for key in "abc"}
+    cache.set("pages", "a", values["a"])
+    cache.set("pages", "b", values["b"])
+    assert cache.get("pages", "a") == values["a"]
+    cache.set("pages", "c", values["c"])
+
+    assert cache.get("pages", "b") is None
+    assert cache.get("pages", "a") == values["a"]
+    assert cache.get("pages", "c") == values["c"]
+    cache.close()
+
+
+def test_disabled_without_path():
+    cache = DiskCache(path=None)
+    cache.set("transcriptions", "7", "transcript")
+    assert cache.get("transcriptions", "7") is None
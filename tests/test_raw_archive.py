@@ -0,0 +1,31 @@
+import glob
+import os
+
+from reclaim_tiktok.scrapping.raw_archive import RawArchive
+
+
+def payloads(n):
+    return [{"id": str(7_300_000_000_000_000_000 + i), "desc": f"video {i}"} for i in range(n)]
+
+
+def test_payloads_are_read_back(tmp_path):
+    with RawArchive(str(tmp_path), frame_payloads=100) as archive:
+        for payload in payloads(250):
+            archive.write(payload)
+    assert list(RawArchive(str(tmp_path)).iter_payloads()) == payloads(250)
+
+
+def test_unfinished_file_is_read_up_to_its_last_frame(tmp_path):
+    archive = RawArchive(str(tmp_path), frame_payloads=100)
+    for payload in payloads(250):
+        archive.write(payload)
+    # the crawler is killed: the last frame is never ended and the file is cut off
+    archive._writer.flush()
+    archive._file.flush()
+    (path,) = glob.glob(os.path.join(str(tmp_path), "*", "*"))
+    with open(path, "rb") as f:
+        data = f.read()
+    with open(path, "wb") as f:
+        f.write(data[:-5])
+
+    assert list(RawArchive(str(tmp_path)).iter_payloads()) == payloads(200)
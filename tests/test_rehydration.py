@@ -0,0 +1,44 @@
+import json
+
+import pytest
+
+from reclaim_tiktok.transcriber.tiktok_video_details import (
+    REHYDRATION_SCRIPT_ID,
+    parse_rehydration_json,
+)
+
+VIDEO_DETAIL = {"itemInfo": {"itemStruct": {"id": "7", "desc": "a video"}}, "statusCode": 0}
+REHYDRATION_JSON = json.dumps(
+    {"__DEFAULT_SCOPE__": {"webapp.app-context": {}, "webapp.video-detail": VIDEO_DETAIL}}
+)
+
+
+def page(id_attribute):
+    return (
+        "<html><head></head><body><div>#fyp</div>"
+        f'<script {id_attribute} type="application/json">{REHYDRATION_JSON}</script>'
+        "</body></html>"
+    )
+
+
+@pytest.mark.parametrize(
+    "id_attribute",
+    [
+        f'id="{REHYDRATION_SCRIPT_ID}"',
+        f"id='{REHYDRATION_SCRIPT_ID}'",
+        f"id={REHYDRATION_SCRIPT_ID}",
+        f'id = "{REHYDRATION_SCRIPT_ID}"',
+    ],
+)
+def test_parse_rehydration_json_finds_the_video_detail(id_attribute):
+    tt_json = parse_rehydration_json(page(id_attribute))
+    assert tt_json["__DEFAULT_SCOPE__"]["webapp.video-detail"] == VIDEO_DETAIL
+
+
+def test_parse_rehydration_json_without_script():
+    assert parse_rehydration_json("<html><body>Please wait...</body></html>") is None
+
+
+def test_parse_rehydration_json_without_video_detail():
+    html = page(f'id="{REHYDRATION_SCRIPT_ID}"').replace('"webapp.video-detail"', '"other"')
+    assert "webapp.video-detail" not in parse_rehydration_json(html)["__DEFAULT_SCOPE__"]
@@ -0,0 +1,116 @@
+import asyncio
+import contextlib
+
+import pytest
+
+from reclaim_tiktok.scrapping.rate_limiter import AdaptiveRateLimiter
+from reclaim_tiktok.scrapping.scrapper import Scrapper
+from reclaim_tiktok.scrapping.seen_filter import BloomFilter, SeenIds, make_seen_filter
+
+UNLIMITED = 10**9
+
+
+class FakeVideo:
+    def __init__(self, id_):
+        self.id = str(id_)
+        self.as_dict = {"id": self.id, "createTime": 1_700_000_000 + id_}
+
+
+def make_scrapper(seen_filter):
+    return Scrapper(
+        ms_token="test",
+        rate_limiter=AdaptiveRateLimiter(
+            initial_rate=UNLIMITED, max_rate=UNLIMITED, burst=UNLIMITED
+        ),
+        seen_filter=seen_filter,
+    )
+
+
+def feed(ids):
+    async def videos_from(cursor, count):
+        for id_ in ids[cursor : cursor + count]:
+            # hand over to the other crawls like a page request would
+            await asyncio.sleep(0)
+            yield FakeVideo(id_)
+
+    return videos_from
+
+
+async def crawl(scrapper, key, ids):
+    found = []
+    async with contextlib.aclosing(
+        scrapper._iter_checkpointed("hashtag", key, len(ids), feed(ids))
+    ) as videos:
+        async for video in videos:
+            # hand over to the other crawls like a full queue would
+            await asyncio.sleep(0)
+            found.append(int(video.id))
+    return found
+
+
+@pytest.mark.parametrize("seen_filter", [SeenIds(), BloomFilter(memory_bytes=1024)])
+def test_add_and_contains(seen_filter):
+    assert 7 not in seen_filter
+    assert seen_filter.add(7)
+    assert "7" in seen_filter
+    assert not seen_filter.add("7")
+    seen_filter.clear()
+    assert 7 not in seen_filter
+
+
+def test_seen_ids_discard():
+    seen_filter = SeenIds()
+    seen_filter.add(7)
+    seen_filter.discard(7)
+    assert 7 not in seen_filter
+    assert seen_filter.add(7)
+
+
+def test_bloom_filter_false_positive_rate():
+    # 1.2 bytes per id: about 1% false positives
+    seen_filter = make_seen_filter(memory_budget_bytes=12_000, expected_items=10_000)
+    for id_ in range(10_000):
+        seen_filter.add(7_300_000_000_000_000_000 + id_)
+    assert all(7_300_000_000_000_000_000 + id_ in seen_filter for id_ in range(10_000))
+
+    false_positives = sum(7_400_000_000_000_000_000 + id_ in seen_filter for id_ in range(100_000))
+    assert false_positives / 100_000 < 0.02
+
+
+def test_concurrent_crawls_yield_a_shared_id_once():
+    scrapper = make_scrapper(SeenIds())
+
+    async def crawl_both():
+        return await asyncio.gather(
+            crawl(scrapper, "a", [1, 2, 3, 4]), crawl(scrapper, "b", [5, 2, 6, 4])
+        )
+
+    found_a, found_b = asyncio.run(crawl_both())
+    assert sorted(found_a + found_b) == [1, 2, 3, 4, 5, 6]
+    duplicates = sum(stats["duplicates"] for stats in scrapper.overlap_stats.values())
+    assert duplicates == 2
+
+
+def test_video_not_taken_is_yielded_by_another_crawl():
+    scrapper = make_scrapper(SeenIds())
+
+    async def fail_on_first_video():
+        async with contextlib.aclosing(
+            scrapper._iter_checkpointed("hashtag", "a", 2, feed([1, 2]))
+        ) as videos:
+            async for _ in videos:
+                raise RuntimeError("consumer failed")
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(fail_on_first_video())
+    assert asyncio.run(crawl(scrapper, "b", [1, 3])) == [1, 3]
+
+
+def test_seen_filter_is_reset_per_crawl():
+    scrapper = make_scrapper(SeenIds())
+    assert asyncio.run(crawl(scrapper, "a", [1, 2])) == [1, 2]
+    assert asyncio.run(crawl(scrapper, "b", [2, 3])) == [3]
+
+    scrapper.reset_seen_filter()
+    assert scrapper.overlap_stats == {}
+    assert asyncio.run(crawl(scrapper, "b", [2, 3])) == [2, 3]
@@ -0,0 +1,32 @@
+import pytest
+
+from reclaim_tiktok.transcriber.tiktok_video_details import vtt_to_transcript
+
+
+def test_vtt_to_transcript_joins_the_cue_texts():
+    vtt = (
+        "WEBVTT\n\n"
+        "1\n00:00:00.000 --> 00:00:01.500\nHallo <c.white>zusammen</c>\n\n"
+        "00:01.500 --> 00:03.000 line:90%\nzweite\nZeile\n"
+    )
+    assert vtt_to_transcript(vtt) == "Hallo zusammen zweite\nZeile "
+
+
+def test_vtt_to_transcript_skips_header_notes_and_invalid_cues():
+    vtt = (
+        "﻿WEBVTT\r\nKind: captions\r\n\r\n"
+        "NOTE generated\r\n\r\n"
+        "00:00:00.000 --> 00:00:01.000\r\nA\r\n\r\n"
+        "00:00:61.000 --> 00:00:62.000\r\ninvalid timestamp\r\n\r\n"
+        "00:00:02.000 --> 00:00:03.000\r\nB\r\n"
+    )
+    assert vtt_to_transcript(vtt) == "A B "
+
+
+def test_vtt_to_transcript_without_cues():
+    assert vtt_to_transcript("WEBVTT\n") == ""
+
+
+@pytest.mark.parametrize("content", ["", "<html><body>Not found</body></html>", "1\nWEBVTT"])
+def test_vtt_to_transcript_of_other_content(content):
+    assert vtt_to_transcript(content) is None